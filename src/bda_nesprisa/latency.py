@@ -0,0 +1,128 @@
+import random
+import threading
+from time import sleep
+from typing import Optional, TypedDict
+from sqlalchemy import DDL, MetaData, event
+from sqlalchemy.pool import StaticPool
+from sqlmodel import SQLModel, create_engine
+from bda_nesprisa.sharding import Seed
+
+# LATENCY STAND-IN
+
+# Most of the time of a real run is spent in network round trips to the remote Oracle host, which a local SQLite
+# database hides completely, so the LatencyInjector wraps a SQLite engine to behave like a remote one:
+# 1. Every statement sent to the database (and every commit and rollback) waits for a round trip,
+#    plus a time for each row it sends (e.g. the rows of an executemany), with some random jitter
+# 2. It counts the round trips, statements and rows, so the effect of batching or removing queries can be
+#    measured and checked offline
+# Its engine can be passed to the main function as main(engine=injector.engine)
+
+# The schema is created in the SQLite database, with one change: SQLite can't autoincrement a column of a composite
+# primary key (carrito.id_carrito), so we let it be NULL on insert and a trigger sets it to the rowid, which is
+# what SQLAlchemy reads back as the id of the new carrito
+
+
+class LatencyStats(TypedDict):
+    round_trips: int
+    statements: int
+    commits: int
+    rows: int
+    # Total time waited because of the injected latency
+    seconds: float
+
+
+class LatencyInjector:
+    def __init__(
+        self,
+        url: str = "sqlite://",
+        round_trip: float = 0.005,
+        per_row: float = 0.00005,
+        jitter: float = 0.2,
+        seed: Optional[Seed] = None,
+        create_schema: bool = True,
+    ):
+        self.round_trip = round_trip
+        self.per_row = per_row
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats: LatencyStats = {
+            "round_trips": 0,
+            "statements": 0,
+            "commits": 0,
+            "rows": 0,
+            "seconds": 0.0,
+        }
+
+        # An in-memory SQLite database only exists in its connection, so all threads (e.g. the workload clients)
+        # have to share the same one
+        # We also disable insertmanyvalues so inserts of many rows are sent as an executemany whose rows we can count
+        self.engine = (
+            create_engine(
+                url,
+                poolclass=StaticPool,
+                connect_args={"check_same_thread": False},
+                use_insertmanyvalues=False,
+            )
+            if url in ("sqlite://", "sqlite:///:memory:")
+            else create_engine(url, use_insertmanyvalues=False)
+        )
+        if create_schema:
+            self.create_schema()
+
+        event.listen(self.engine, "before_cursor_execute", self.before_execute)
+        event.listen(self.engine, "commit", self.before_commit)
+        event.listen(self.engine, "rollback", self.before_commit)
+
+    def create_schema(self):
+        metadata = MetaData()
+        for table in SQLModel.metadata.sorted_tables:
+            table.to_metadata(metadata)
+
+        id_carrito = metadata.tables["carrito"].c.id_carrito
+        id_carrito.autoincrement = False
+        id_carrito.nullable = True
+        event.listen(
+            metadata.tables["carrito"],
+            "after_create",
+            DDL(
+                "CREATE TRIGGER carrito_id_carrito AFTER INSERT ON carrito WHEN NEW.id_carrito IS NULL"
+                " BEGIN UPDATE carrito SET id_carrito = NEW.rowid WHERE rowid = NEW.rowid; END"
+            ),
+        )
+        metadata.create_all(self.engine)
+
+    def wait(self, rows: int):
+        with self.lock:
+            seconds = (self.round_trip + self.per_row * rows) * (
+                1 + self.rng.uniform(-self.jitter, self.jitter)
+            )
+            self.stats["round_trips"] += 1
+            self.stats["rows"] += rows
+            self.stats["seconds"] += seconds
+        sleep(seconds)
+
+    def before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        with self.lock:
+            self.stats["statements"] += 1
+        self.wait(len(parameters) if executemany else 1)
+
+    def before_commit(self, conn):
+        with self.lock:
+            self.stats["commits"] += 1
+        self.wait(0)
+
+    def reset(self):
+        with self.lock:
+            for stat in self.stats:
+                self.stats[stat] = 0
+
+    def format_stats(self):
+        return (
+            f"{self.stats['round_trips']} round trips ({self.stats['statements']} statements, "
+            f"{self.stats['commits']} commits and rollbacks) sending {self.stats['rows']} rows, "
+            f"{self.stats['seconds']:.2f} s of injected latency"
+        )
+
+
+__all__ = ["LatencyStats", "LatencyInjector"]
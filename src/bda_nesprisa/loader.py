@@ -0,0 +1,177 @@
+import json
+import resource
+from contextlib import nullcontext
+from itertools import islice
+from time import perf_counter
+from typing import Any, Callable, ContextManager, Iterable, Optional, TypedDict
+from sqlmodel import Session, SQLModel
+from bda_nesprisa.tables.types import TableName
+
+# LOADER
+
+# Rows are inserted and committed in batches, and the best batch size depends on the latency to the database
+# and on how wide the rows of each table are, so the loader tunes it while loading each table:
+# 1. It starts with the size given for the table (e.g. the one chosen in a previous run) or a default one
+# 2. While the rows per second keep improving, it doubles the batch size
+# 3. When a batch takes longer than the maximum latency or the process uses more memory than the maximum,
+#    it halves the batch size and stops growing (for memory only once, since smaller batches can't free
+#    the memory held outside the batch, e.g. by the rows still to load)
+# 4. When the rows per second stop improving, it goes back to the best batch size found and keeps it
+# The chosen batch size of each table is written in the run report, so later runs can start from it
+# The rows are generated as each batch is loaded, so only one batch of rows is in memory at a time
+# The rows are not read back after inserting them, the main function checks them all at once after loading
+# each table (see verification.py)
+# NOTE: since each batch is committed, if a batch fails the previous batches of the table stay in the database
+
+DEFAULT_BATCH_SIZE = 500
+MIN_BATCH_SIZE = 10
+MAX_BATCH_SIZE = 50_000
+
+# Relative improvement of the rows per second needed to keep growing the batch size
+IMPROVEMENT = 0.05
+
+
+class LoadOptions(TypedDict):
+    # Maximum seconds a batch can take
+    max_latency: float
+    # Maximum resident memory of the process in bytes (None for no limit)
+    max_memory: Optional[int]
+
+
+DEFAULT_LOAD_OPTIONS: LoadOptions = {"max_latency": 5.0, "max_memory": None}
+
+
+class TableReport(TypedDict):
+    rows: int
+    generate_seconds: float
+    load_seconds: float
+    verify_seconds: float
+    batches: int
+    batch_size: Optional[int]
+
+
+# Resident memory of the process in bytes
+def rss():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # Outside Linux we can only get the peak memory (which macOS gives in bytes)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class BatchTuner:
+    def __init__(
+        self,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        max_latency: float = 5.0,
+        max_memory: Optional[int] = None,
+    ):
+        self.batch_size = min(max(batch_size, MIN_BATCH_SIZE), MAX_BATCH_SIZE)
+        self.max_latency = max_latency
+        self.max_memory = max_memory
+        self.growing = True
+        self.best_size = self.batch_size
+        self.best_rate = 0.0
+        # Batch size when the process first went over the maximum memory
+        self.memory_size: Optional[int] = None
+
+    # Updates the batch size with the time it took to load a batch of num_rows rows
+    def record(self, num_rows: int, seconds: float):
+        over_memory = self.max_memory is not None and rss() > self.max_memory
+        if over_memory:
+            if self.memory_size is None:
+                self.memory_size = self.batch_size
+            # Once halved, the batches are already smaller than when the memory went over the maximum
+            over_memory = self.batch_size >= self.memory_size
+        if seconds > self.max_latency or over_memory:
+            self.batch_size = max(self.batch_size // 2, MIN_BATCH_SIZE)
+            self.best_size = min(self.best_size, self.batch_size)
+            self.growing = False
+            return
+
+        # Batches smaller than the batch size (the last one of a table) don't tell anything about the batch size
+        if num_rows < self.batch_size:
+            return
+
+        rate = num_rows / seconds if seconds > 0 else float("inf")
+        if rate > self.best_rate * (1 + IMPROVEMENT):
+            self.best_rate = rate
+            self.best_size = self.batch_size
+            if self.growing:
+                self.batch_size = min(self.batch_size * 2, MAX_BATCH_SIZE)
+        elif self.growing:
+            self.growing = False
+            self.batch_size = self.best_size
+
+
+# Generates and inserts the rows of a table in batches tuned by the tuner, using phase to profile the generation,
+# insert and commit of each batch, and calls loaded (if given) with each batch once it is flushed, e.g. to add it to
+# the checksum of the table so it can be verified after loading it
+# The rows, batches and generation and load seconds of the table are added to its report
+def load_rows(
+    session: Session,
+    table: TableName,
+    table_rows: Iterable[SQLModel],
+    tuner: BatchTuner,
+    report: TableReport,
+    phase: Callable[[TableName, str], ContextManager] = lambda *_: nullcontext(),
+    loaded: Optional[Callable[[list[SQLModel]], Any]] = None,
+):
+    table_rows = iter(table_rows)
+    while True:
+        generate_start = perf_counter()
+        with phase(table, "generate"):
+            batch = list(islice(table_rows, tuner.batch_size))
+        report["generate_seconds"] += perf_counter() - generate_start
+        if not batch:
+            break
+
+        load_start = perf_counter()
+        # Add the rows to the session and flush them, which sends the INSERT statements
+        with phase(table, "insert"):
+            session.add_all(batch)
+            session.flush()
+        seconds = perf_counter() - load_start
+
+        # After the flush the values assigned by the database (e.g. carrito ids) are in the rows
+        # (outside of the timed insert and commit, so its cost doesn't tune the batch size)
+        if loaded is not None:
+            loaded(batch)
+
+        commit_start = perf_counter()
+        with phase(table, "commit"):
+            session.commit()
+        tuner.record(len(batch), seconds + perf_counter() - commit_start)
+
+        report["rows"] += len(batch)
+        report["batches"] += 1
+        report["load_seconds"] += perf_counter() - load_start
+
+
+# Reads the batch sizes chosen in a previous run from its report
+def read_batch_sizes(path: str):
+    with open(path) as file:
+        tables: dict[TableName, TableReport] = json.load(file)["tables"]
+    return {
+        table: report["batch_size"]
+        for table, report in tables.items()
+        if report["batch_size"] is not None
+    }
+
+
+def write_report(path: str, tables: dict[TableName, TableReport]):
+    with open(path, "w") as file:
+        json.dump({"tables": tables}, file, indent=2)
+
+
+__all__ = [
+    "DEFAULT_BATCH_SIZE",
+    "DEFAULT_LOAD_OPTIONS",
+    "LoadOptions",
+    "TableReport",
+    "BatchTuner",
+    "load_rows",
+    "read_batch_sizes",
+    "write_report",
+]
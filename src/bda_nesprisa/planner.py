@@ -0,0 +1,163 @@
+from time import perf_counter
+from typing import Optional, TypedDict
+import tracemalloc
+from tqdm import tqdm
+from bda_nesprisa.tables.types import TableName, table_names
+from bda_nesprisa.tables import CreateRowsDictValue, fake, table_specs
+from bda_nesprisa.tables.keystore import KeyStore
+
+# CAPACITY PLANNER
+
+# Before inserting anything we go through the create_rows dict and check that the number of rows
+# asked for each table fits in its key space (e.g. anyadir can't have more rows than aditivos x variedades),
+# since otherwise the generation functions fail halfway when there are no unique keys left to choose from
+# and all the previous tables are already committed
+
+# Besides, the planner can estimate how long and how much memory each table will take by measuring
+# the cost per row of generating a small sample of every table
+# NOTE: the estimation is linear, so for tables whose generation function is not linear it is a lower bound
+
+
+class TablePlan(TypedDict):
+    requested_rows: int
+    num_rows: int
+    key_space: Optional[int]
+    seconds: Optional[float]
+    memory: Optional[int]
+
+
+def plan_rows(
+    create_rows: dict[TableName, CreateRowsDictValue],
+    clamp: bool = False,
+    estimate: bool = False,
+    sample_rows: int = 10,
+    existing: Optional[dict[TableName, int]] = None,
+):
+    plan: dict[TableName, TablePlan] = {}
+    existing = existing or {}
+
+    # Number of rows each table will have, filled in order so the key space of a table is computed
+    # from the (possibly clamped) number of rows of its parents
+    counts: dict[TableName, int] = {}
+    infeasible: list[str] = []
+
+    for table in table_names:
+        requested_rows = create_rows[table]["num_rows"]
+        key_space = create_rows[table]["key_space"](counts)
+        num_rows = requested_rows
+
+        # Tables that are already in the database (e.g. when only some tables are regenerated) are not
+        # generated, but the key spaces of their children depend on how many rows they really have
+        if table in existing:
+            requested_rows = num_rows = existing[table]
+        elif key_space is not None and requested_rows > key_space:
+            if clamp:
+                num_rows = key_space
+            else:
+                infeasible.append(
+                    f"{table} ({requested_rows} rows requested but only {key_space} unique keys)"
+                )
+
+        counts[table] = num_rows
+        plan[table] = {
+            "requested_rows": requested_rows,
+            "num_rows": num_rows,
+            "key_space": key_space,
+            "seconds": None,
+            "memory": None,
+        }
+
+    # We fail before generating anything so nothing gets committed
+    if infeasible:
+        raise ValueError(
+            "The number of rows of some tables exceeds their key space: "
+            + ", ".join(infeasible)
+        )
+
+    if estimate:
+        for table, (seconds, memory) in measure_row_costs(
+            create_rows, counts, sample_rows
+        ).items():
+            plan[table]["seconds"] = seconds * counts[table]
+            plan[table]["memory"] = memory * counts[table]
+
+    return plan
+
+
+# We measure the cost per row by creating a small sample of every table in memory, in the same order as the main
+# function does, so every table gets sample rows of its parents as dependencies
+def measure_row_costs(
+    create_rows: dict[TableName, CreateRowsDictValue],
+    counts: dict[TableName, int],
+    sample_rows: int,
+):
+    costs: dict[TableName, tuple[float, float]] = {}
+
+    # The generation functions expect a progress bar, so we give them a disabled one
+    # The first samples pay one-time costs (e.g. Faker loading its providers or the first instances of the models)
+    # that would be scaled up to the whole table, so we generate all the samples once before measuring them
+    with tqdm(disable=True) as pbar:
+        for measuring in (False, True):
+            rows: dict[TableName, KeyStore] = {}
+            sample_counts: dict[TableName, int] = {}
+            if measuring:
+                tracemalloc.start()
+            try:
+                for table in table_names:
+                    # The sample can't be bigger than the real table nor than the key space of the sample parents
+                    num_rows = min(sample_rows, counts[table])
+                    key_space = create_rows[table]["key_space"](sample_counts)
+                    if key_space is not None:
+                        num_rows = min(num_rows, key_space)
+                    sample_counts[table] = num_rows
+
+                    rows_list = {f"{k}_list": v for k, v in rows.items()}
+                    memory_before = tracemalloc.get_traced_memory()[0]
+                    start = perf_counter()
+                    created = list(
+                        create_rows[table]["fn"](
+                            **rows_list, num_rows=num_rows, pbar=pbar
+                        )
+                    )
+                    seconds = perf_counter() - start
+                    memory = tracemalloc.get_traced_memory()[0] - memory_before
+
+                    # Only the keys of the sample are kept for the next tables, and we free its rows now so they
+                    # aren't freed while measuring the next table, which would subtract them from its memory
+                    rows[table] = KeyStore(table_specs[table]["model"])
+                    rows[table].extend(created)
+                    del created
+
+                    costs[table] = (
+                        (seconds / num_rows, max(memory, 0) / num_rows)
+                        if num_rows
+                        else (0.0, 0.0)
+                    )
+            finally:
+                if measuring:
+                    tracemalloc.stop()
+                # The samples used some of the values that Faker guarantees to be unique (e.g. variedad
+                # denominations), so we forget them to have all of them available for the next pass and the real run
+                fake.unique.clear()
+
+    return costs
+
+
+def format_plan(plan: dict[TableName, TablePlan]):
+    lines = [
+        f"{'table':<24}{'rows':>10}{'requested':>11}{'key space':>12}{'time (s)':>11}{'memory (MB)':>13}"
+    ]
+    for table, table_plan in plan.items():
+        key_space = table_plan["key_space"]
+        seconds = table_plan["seconds"]
+        memory = table_plan["memory"]
+        lines.append(
+            f"{table:<24}{table_plan['num_rows']:>10}{table_plan['requested_rows']:>11}"
+            f"{'-' if key_space is None else key_space:>12}"
+            f"{'-' if seconds is None else f'{seconds:.2f}':>11}"
+            f"{'-' if memory is None else f'{memory / 2**20:.2f}':>13}"
+        )
+    return "\n".join(lines)
+
+
+__all__ = ["TablePlan", "plan_rows", "format_plan"]
@@ -0,0 +1,160 @@
+import cProfile
+import pstats
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from io import StringIO
+from pathlib import Path
+from typing import Literal, Optional
+from bda_nesprisa.tables.types import TableName
+
+# PROFILING
+
+# The main function can profile separately each phase of each table:
+# - generate: the call to the create_rows function of the table
+# - insert: adding the rows to the session and flushing them, which sends the INSERT statements
+# - commit: committing the transaction
+# - verify: checking the loaded rows with aggregate queries (see verification.py)
+
+# There are two modes:
+# 1. deterministic: uses cProfile, which records every function call, so it is exact but makes the run slower.
+#    It writes a {table}.{phase}.prof file for each phase that can be opened with pstats or snakeviz
+# 2. sampling: a background thread looks at the stack of the main thread every few milliseconds, so it barely
+#    slows the run down and can be left on in production runs. It writes a {table}.{phase}.folded file for each
+#    phase with the sampled stacks in the collapsed format used by flame graph tools
+# In both modes a summary.txt file with the top hot functions of the whole run is written at the end
+
+ProfileMode = Literal["deterministic", "sampling"]
+Phase = Literal["generate", "insert", "commit", "verify"]
+
+
+class Profiler:
+    def __init__(
+        self,
+        directory: str,
+        mode: ProfileMode = "deterministic",
+        top: int = 30,
+        interval: float = 0.005,
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.mode = mode
+        self.top = top
+        self.interval = interval
+
+        # Deterministic mode: the profile of each phase (a phase can run several times, e.g. once per batch,
+        # so its profile is enabled every time and dumped at the end) and the paths of the dumped profiles
+        self.profiles: dict[tuple[TableName, Phase], cProfile.Profile] = {}
+        self.dumps: list[Path] = []
+
+        # Sampling mode: the phase being run (set by the main thread and read by the sampler thread)
+        # and the number of times each stack has been sampled in each phase
+        self.current: Optional[tuple[TableName, Phase]] = None
+        self.stacks: dict[tuple[TableName, Phase], Counter] = {}
+        self.sampler: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+
+    @contextmanager
+    def phase(self, table: TableName, phase: Phase):
+        if self.mode == "deterministic":
+            profile = self.profiles.setdefault((table, phase), cProfile.Profile())
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+        else:
+            if self.sampler is None:
+                self.start_sampler(threading.get_ident())
+            self.current = (table, phase)
+            try:
+                yield
+            finally:
+                self.current = None
+
+    def start_sampler(self, thread_id: int):
+        def sample():
+            while not self.stopped.wait(self.interval):
+                current = self.current
+                frame = sys._current_frames().get(thread_id)
+                if current is None or frame is None:
+                    continue
+
+                # We keep the stack from the outermost to the innermost call
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                self.stacks.setdefault(current, Counter())[tuple(reversed(stack))] += 1
+
+        self.sampler = threading.Thread(target=sample, daemon=True)
+        self.sampler.start()
+
+    # Stops the sampler (if any) and writes the profile files of the sampling mode and the summary
+    def close(self):
+        if self.sampler is not None:
+            self.stopped.set()
+            self.sampler.join()
+
+        if self.mode == "deterministic":
+            for (table, phase), profile in self.profiles.items():
+                path = self.directory / f"{table}.{phase}.prof"
+                profile.dump_stats(path)
+                self.dumps.append(path)
+            summary = self.deterministic_summary()
+        else:
+            for (table, phase), stacks in self.stacks.items():
+                with open(self.directory / f"{table}.{phase}.folded", "w") as file:
+                    for stack, count in stacks.items():
+                        file.write(f"{';'.join(stack)} {count}\n")
+            summary = self.sampling_summary()
+
+        path = self.directory / "summary.txt"
+        path.write_text(summary)
+        return path
+
+    def deterministic_summary(self):
+        if not self.dumps:
+            return "No phases were profiled\n"
+
+        output = StringIO()
+        output.write(f"Merged {len(self.dumps)} profiles from {self.directory}\n")
+        stats = pstats.Stats(*map(str, self.dumps), stream=output)
+        # pstats prints a header line for every merged file, which we already summarized above
+        stats.files = []
+        stats.sort_stats("tottime").print_stats(self.top)
+        stats.sort_stats("cumulative").print_stats(self.top)
+        return output.getvalue()
+
+    def sampling_summary(self):
+        # Samples where each function was running (self) and where it was anywhere in the stack (inclusive)
+        own: Counter = Counter()
+        inclusive: Counter = Counter()
+        phases: Counter = Counter()
+        for current, stacks in self.stacks.items():
+            for stack, count in stacks.items():
+                own[stack[-1]] += count
+                for function in set(stack):
+                    inclusive[function] += count
+                phases[current] += count
+
+        total = sum(phases.values())
+        if not total:
+            return "No samples were taken\n"
+
+        lines = [f"{total} samples every {self.interval * 1000:g} ms", ""]
+        lines.append("Samples per phase:")
+        for (table, phase), count in phases.most_common():
+            lines.append(f"{count:>8} {count / total:>7.1%}  {table}.{phase}")
+        for title, counter in (("self", own), ("inclusive", inclusive)):
+            lines.extend(["", f"Top {self.top} functions by {title} samples:"])
+            for function, count in counter.most_common(self.top):
+                lines.append(f"{count:>8} {count / total:>7.1%}  {function}")
+        return "\n".join(lines) + "\n"
+
+
+__all__ = ["ProfileMode", "Profiler"]
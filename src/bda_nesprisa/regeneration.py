@@ -0,0 +1,143 @@
+import pickle
+from argparse import ArgumentTypeError
+from pathlib import Path
+from itertools import islice
+from typing import Iterable, Optional
+from sqlalchemy import delete
+from sqlmodel import Session, select
+from tqdm import tqdm
+from bda_nesprisa.tables import table_specs
+from bda_nesprisa.tables.engine import parent_tables, primary_key
+from bda_nesprisa.tables.keystore import CHUNK_SIZE, KeyBudget, KeyStore, key_columns
+from bda_nesprisa.tables.types import TableName, table_names
+from bda_nesprisa.verification import Checksum, aggregates
+
+# PARTIAL REGENERATION
+
+# When we only change the generator of some tables, we don't need to reload all of them:
+# 1. The selected tables and every table that depends on them (following the foreign keys) are regenerated
+# 2. Their rows are deleted from the database (children first) and loaded again in the usual order
+# 3. The rest of tables are not touched, but the regenerated tables need the rows of their parents, so they are
+#    read from a local key cache (if the table is in it) or from the database
+# The key cache is a directory with a file for each table with the primary and foreign key columns of its rows,
+# which the main function writes after loading each table when it is given one
+# Each file also has the count and checksum of the rows (see verification.py), and it is only used if they are
+# still the ones of the table in the database (e.g. the table may have been regenerated without the key cache)
+# Rows read from the key cache or the database are kept in a key store, like the ones the main function generates
+
+
+# Type for the --tables argument, which has the format table,table,...
+def parse_tables(value: str):
+    tables = value.split(",")
+    for table in tables:
+        if table not in table_names:
+            raise ArgumentTypeError(
+                f"unknown table {table!r}, choose from {', '.join(table_names)}"
+            )
+    return tables
+
+
+# Returns the selected tables and all the tables that depend on them, in the order they have to be loaded
+def dependent_tables(selected: Iterable[TableName]):
+    affected = set(selected)
+    # table_names is in load order (parents before children), so one pass reaches every descendant
+    for table in table_names:
+        if parent_tables(table_specs[table]["model"]) & affected:
+            affected.add(table)
+    return [table for table in table_names if table in affected]
+
+
+# Returns the tables that are not regenerated but whose rows are needed by the regenerated ones
+def required_tables(regenerated: list[TableName], extra: Iterable[TableName] = ()):
+    required = set(extra)
+    for table in regenerated:
+        required |= parent_tables(table_specs[table]["model"])
+    return [
+        table for table in table_names if table in required and table not in regenerated
+    ]
+
+
+def key_cache_path(key_cache: str, table: TableName):
+    return Path(key_cache) / f"{table}.pickle"
+
+
+# Writes the keys of the rows of a table from its key store, which is read twice (for the checksum and the keys)
+# instead of keeping the rows in memory
+def write_keys(key_cache: str, table: TableName, store: KeyStore):
+    model = table_specs[table]["model"]
+    columns = key_columns(model)
+    checksum = Checksum(model)
+    checksum.add(store)
+    path = key_cache_path(key_cache, table)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as file:
+        pickle.dump((columns, checksum.values()), file)
+        # The keys are written in chunks, so they can be read back without loading all of them at once
+        keys = iter(store)
+        while chunk := list(islice(keys, CHUNK_SIZE)):
+            pickle.dump(
+                [tuple(getattr(row, column) for column in columns) for row in chunk],
+                file,
+            )
+
+
+# Reads the keys of a key cache file chunk by chunk, after its header
+def read_keys(file):
+    while True:
+        try:
+            chunk = pickle.load(file)
+        except EOFError:
+            return
+        yield from chunk
+
+
+# Reads the key columns of the rows of a table from the key cache or, if it is not there, from the database
+def read_rows(
+    session: Session,
+    table: TableName,
+    key_cache: Optional[str] = None,
+    key_budget: Optional[KeyBudget] = None,
+):
+    model = table_specs[table]["model"]
+    path = key_cache_path(key_cache, table) if key_cache is not None else None
+    if path is not None and path.exists():
+        with open(path, "rb") as file:
+            columns, values = pickle.load(file)
+            if values == aggregates(session, model):
+                store = KeyStore(model, columns, key_budget)
+                store.extend_keys(read_keys(file))
+                return store
+        tqdm.write(
+            f"The key cache of {table} is outdated, reading it from the database"
+        )
+
+    columns = key_columns(model)
+    # We sort the rows by their primary key so seeded runs read them always in the same order,
+    # use execute instead of exec, which would return single values instead of tuples for one column,
+    # and fetch them in parts so they can be spilled to disk while reading them
+    keys = session.execute(
+        select(*(getattr(model, column) for column in columns)).order_by(
+            *(getattr(model, column) for column in primary_key(model))
+        ),
+        execution_options={"yield_per": 10_000},
+    )
+    store = KeyStore(model, columns, key_budget)
+    store.extend_keys(keys)
+    return store
+
+
+# Deletes all the rows of the tables, children first so no foreign key is violated
+def delete_tables(session: Session, tables: list[TableName]):
+    for table in reversed(tables):
+        session.execute(delete(table_specs[table]["model"]))
+    session.commit()
+
+
+__all__ = [
+    "parse_tables",
+    "dependent_tables",
+    "required_tables",
+    "write_keys",
+    "read_rows",
+    "delete_tables",
+]
@@ -0,0 +1,177 @@
+import random
+from argparse import ArgumentTypeError
+from time import monotonic, sleep
+from typing import Iterable, NamedTuple, Optional, Union
+from sqlalchemy.engine import Engine
+from sqlmodel import Session
+from bda_nesprisa.tables.types import Carrito, TableName
+from bda_nesprisa.tables import CreateRowsDictValue, fake, table_specs
+from bda_nesprisa.tables.keystore import KeyStore
+from bda_nesprisa.verification import Checksum, aggregates
+
+# SHARDING
+
+# In order to split very large loads across several machines, each one runs the script independently as
+# one shard i of N shards, with no coordination between them:
+# 1. Dimension tables (pais, variedad, tienda, ...) are generated identically in every shard, since every table
+#    is generated from its own seed derived from a common seed, so all shards share the same parent keys
+# 2. Fact tables are split so every shard creates a disjoint part of them:
+#    - carrito: each shard creates its share of the rows and assigns the id_carrito itself from
+#      an interleaved sequence (shard i of N uses the ids i + 1, i + 1 + N, i + 1 + 2N, ...)
+#    - contiene: its keys start with the carrito key, so they are disjoint as long as the carritos are
+#    - tiene_cafetera: each shard only uses the clientes whose position is i modulo N
+# 3. All shards load into the same database and only shard 0 inserts the dimension tables (the rest of shards
+#    only generate them to have their keys), so before loading a fact table the rest of shards wait until the count
+#    and checksum of each of its dimension tables in the database are the ones of the rows they generated, which
+#    means shard 0 has finished loading them (the shards can be started in any order)
+# NOTE: the dimension tables have to be empty before the load, otherwise their count never matches and
+#       the shards fail after waiting WAIT_TIMEOUT seconds
+
+Seed = Union[int, str]
+
+# Seconds a shard waits for a dimension table to be loaded by shard 0 and seconds between checks
+WAIT_TIMEOUT = 3600.0
+WAIT_INTERVAL = 5.0
+
+
+class Shard(NamedTuple):
+    index: int
+    count: int
+
+
+# Fact tables and, for each one, the parent table that is partitioned among the shards to keep their keys disjoint
+# (None when the keys are already disjoint because of the carrito ids)
+FACT_TABLES: dict[TableName, Optional[TableName]] = {
+    "carrito": None,
+    "contiene": None,
+    "tiene_cafetera": "cliente",
+}
+
+
+# Type for the --shard argument, which has the format i/N
+def parse_shard(value: str):
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise ArgumentTypeError(f"shard must have the format i/N, not {value!r}")
+    if count < 1 or not 0 <= index < count:
+        raise ArgumentTypeError(
+            f"shard index must be between 0 and N - 1, not {value!r}"
+        )
+    return Shard(index, count)
+
+
+# Number of rows out of num_rows that belong to a shard (the first num_rows % N shards get one more row)
+def shard_num_rows(num_rows: int, shard: Shard):
+    return num_rows // shard.count + (shard.index < num_rows % shard.count)
+
+
+# Returns a copy of the create_rows dict with the number of rows of fact tables reduced to the share of the shard
+# and their key spaces computed with the partitioned parent tables, so the planner checks the shard's own tables
+def shard_create_rows(create_rows: dict[TableName, CreateRowsDictValue], shard: Shard):
+    sharded: dict[TableName, CreateRowsDictValue] = dict(create_rows)
+    for table, partitioned in FACT_TABLES.items():
+        key_space = create_rows[table]["key_space"]
+        if partitioned is not None:
+            # Default arguments to capture the values of this iteration in the lambda
+            key_space = (
+                lambda counts, key_space=key_space, partitioned=partitioned: key_space(
+                    {**counts, partitioned: shard_num_rows(counts[partitioned], shard)}
+                )
+            )
+        sharded[table] = {
+            **create_rows[table],
+            "num_rows": shard_num_rows(create_rows[table]["num_rows"], shard),
+            "key_space": key_space,
+        }
+    return sharded
+
+
+# Seeds the random module and Faker right before generating a table, so every table can be reproduced
+# regardless of the tables generated before it
+# Fact tables also include the shard in the seed so each shard creates different rows
+def seed_table(seed: Seed, table: TableName, shard: Optional[Shard] = None):
+    table_seed = f"{seed}:{table}"
+    if shard is not None and table in FACT_TABLES:
+        table_seed += f":{shard.index}/{shard.count}"
+    random.seed(table_seed)
+    fake.seed_instance(table_seed)
+    # Faker's unique values depend on the ones already used, e.g. by a previous run in the same process
+    fake.unique.clear()
+
+
+# Seeds the random module and Faker right before streaming, with the shard so each shard streams different carts
+def seed_stream(seed: Seed, shard: Optional[Shard] = None):
+    stream_seed = f"{seed}:stream"
+    if shard is not None:
+        stream_seed += f":{shard.index}/{shard.count}"
+    random.seed(stream_seed)
+    fake.seed_instance(stream_seed)
+
+
+# Keeps only the rows of the parent tables that are partitioned for this table
+def shard_dependencies(rows_list: dict[str, KeyStore], table: TableName, shard: Shard):
+    partitioned = FACT_TABLES.get(table)
+    if partitioned is None:
+        return rows_list
+    return {
+        **rows_list,
+        f"{partitioned}_list": rows_list[f"{partitioned}_list"][
+            shard.index :: shard.count
+        ],
+    }
+
+
+# Id of the n-th carrito created by a shard
+def carrito_id(n: int, shard: Shard):
+    return n * shard.count + shard.index + 1
+
+
+# Assigns the ids of the carritos created by a shard as they are created, starting from the n-th carrito of the shard
+def assign_carrito_ids(carritos: Iterable[Carrito], shard: Shard, start: int = 0):
+    for n, carrito in enumerate(carritos, start):
+        carrito.id_carrito = carrito_id(n, shard)
+        yield carrito
+
+
+# Whether a shard has to insert the rows of a table (see the top)
+def loads_table(table: TableName, shard: Shard):
+    return shard.index == 0 or table in FACT_TABLES
+
+
+# Waits until a table loaded by another shard has in the database the count and checksum of the rows we generated
+def wait_for_table(
+    engine: Engine,
+    table: TableName,
+    checksum: Checksum,
+    timeout: float = WAIT_TIMEOUT,
+    interval: float = WAIT_INTERVAL,
+):
+    deadline = monotonic() + timeout
+    while True:
+        # A new session for every check, so we see the rows committed since the previous one
+        with Session(engine) as session:
+            values = aggregates(session, table_specs[table]["model"])
+        if values == checksum.values():
+            return
+        if monotonic() > deadline:
+            raise TimeoutError(
+                f"{table} wasn't loaded by shard 0 after {timeout:g} s"
+                f" (count and checksum {values} instead of {checksum.values()})"
+            )
+        sleep(interval)
+
+
+__all__ = [
+    "Seed",
+    "Shard",
+    "FACT_TABLES",
+    "parse_shard",
+    "shard_create_rows",
+    "seed_table",
+    "seed_stream",
+    "shard_dependencies",
+    "assign_carrito_ids",
+    "loads_table",
+    "wait_for_table",
+]
@@ -0,0 +1,192 @@
+from argparse import ArgumentTypeError
+from random import randint
+from time import perf_counter, sleep
+from typing import Literal, Optional, TypedDict
+from sqlalchemy.engine import Engine
+from sqlmodel import Session
+from tqdm import tqdm
+from bda_nesprisa.sharding import Seed, Shard, assign_carrito_ids, seed_stream
+from bda_nesprisa.tables import create_rows
+from bda_nesprisa.tables.keystore import KeyStore
+from bda_nesprisa.tables.types import Carrito, TableName
+from bda_nesprisa.workload import percentile
+
+# STREAMING
+
+# For soak tests, after the initial load we can keep inserting new carritos with their contiene lines at a steady
+# rate, each cart in its own short transaction, until the script is stopped (Ctrl+C) or for a fixed duration
+# The carts are created with the same functions as in the load and with the tienda, cliente and variedad rows
+# of the run, so they always reference existing keys
+# The rate can be given in transactions per second or in rows per second (each transaction has one carrito row
+# and between 1 and lines contiene rows)
+# With a seed, the stream is seeded with it and the shard, so it can be reproduced and every shard streams
+# different carts
+
+StreamUnit = Literal["transactions", "rows"]
+
+# Tables whose rows the stream needs (carrito to continue the ids of the shard)
+STREAM_TABLES: list[TableName] = ["tienda", "cliente", "variedad", "carrito"]
+# Tables the streamed carritos and contiene lines take their keys from, which can't be empty
+STREAM_PARENTS: list[TableName] = ["tienda", "cliente", "variedad"]
+
+
+class StreamOptions(TypedDict):
+    rate: float
+    unit: StreamUnit
+    duration: Optional[float]
+    lines: int
+
+
+class StreamReport(TypedDict):
+    duration: float
+    transactions: int
+    rows: int
+    transactions_per_second: float
+    rows_per_second: float
+    p50: float
+    p95: float
+    p99: float
+    max: float
+
+
+# Parser of the stream options that have to be positive numbers (e.g. the rate, which divides the time between
+# transactions), so a wrong value fails before loading anything instead of after the whole load
+def positive(kind: type):
+    def parse(value: str):
+        try:
+            number = kind(value)
+        except ValueError:
+            raise ArgumentTypeError(f"{value!r} is not a valid {kind.__name__}")
+        if number <= 0:
+            raise ArgumentTypeError(f"{value!r} must be positive")
+        return number
+
+    return parse
+
+
+# Checks the stream can run with the given options and number of rows of its parent tables
+def check_stream(rate: float, lines: int, counts: dict[TableName, int]):
+    if rate <= 0:
+        raise ValueError(f"The stream rate must be positive, not {rate}")
+    if lines < 1:
+        raise ValueError(f"The streamed carritos need at least 1 line, not {lines}")
+    empty = [table for table in STREAM_PARENTS if not counts[table]]
+    if empty:
+        raise ValueError(f"The stream needs rows in {', '.join(empty)}")
+
+
+def run_stream(
+    engine: Engine,
+    rows: dict[TableName, KeyStore],
+    rate: float,
+    unit: StreamUnit = "transactions",
+    duration: Optional[float] = None,
+    lines: int = 5,
+    shard: Optional[Shard] = None,
+    seed: Optional[Seed] = None,
+):
+    check_stream(rate, lines, {table: len(rows[table]) for table in STREAM_PARENTS})
+    if seed is not None:
+        seed_stream(seed, shard)
+
+    # Commit latency of each transaction
+    latencies: list[float] = []
+    num_rows = 0
+
+    # When sharding, the database doesn't assign the carrito ids, so we continue the sequence of the shard
+    next_carrito = len(rows["carrito"])
+
+    start = perf_counter()
+    # Time at which the next transaction should start to keep the rate
+    scheduled = start
+
+    with Session(engine, expire_on_commit=False) as session, tqdm(
+        desc="Streamed rows"
+    ) as pbar:
+        try:
+            while duration is None or perf_counter() - start < duration:
+                delay = scheduled - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+                elif delay < -1:
+                    # If we fell more than a second behind (e.g. a slow commit), we don't try to catch up
+                    # with a burst of transactions, we just continue at the rate from now on
+                    scheduled = perf_counter()
+
+                carritos = create_rows["carrito"]["fn"](
+                    tienda_list=rows["tienda"],
+                    cliente_list=rows["cliente"],
+                    num_rows=1,
+                    pbar=pbar,
+                )
+                if shard is not None:
+                    carritos = assign_carrito_ids(carritos, shard, start=next_carrito)
+                    next_carrito += 1
+                carritos = list(carritos)
+
+                session.add_all(carritos)
+                # We flush the carrito first so the database assigns its id, which the contiene lines need
+                session.flush()
+
+                carrito_list = KeyStore(Carrito)
+                carrito_list.extend(carritos)
+                contiene = list(
+                    create_rows["contiene"]["fn"](
+                        carrito_list=carrito_list,
+                        variedad_list=rows["variedad"],
+                        num_rows=randint(1, min(lines, len(rows["variedad"]))),
+                        pbar=pbar,
+                    )
+                )
+                session.add_all(contiene)
+                # We only time the commit, which sends the contiene lines and ends the transaction
+                commit_start = perf_counter()
+                session.commit()
+                latencies.append(perf_counter() - commit_start)
+
+                # We don't keep the streamed rows, otherwise a long stream would use more and more memory
+                session.expunge_all()
+
+                transaction_rows = len(carritos) + len(contiene)
+                num_rows += transaction_rows
+                scheduled += (1 if unit == "transactions" else transaction_rows) / rate
+        except KeyboardInterrupt:
+            session.rollback()
+
+    elapsed = perf_counter() - start
+    latencies.sort()
+    report: StreamReport = {
+        "duration": elapsed,
+        "transactions": len(latencies),
+        "rows": num_rows,
+        "transactions_per_second": len(latencies) / elapsed,
+        "rows_per_second": num_rows / elapsed,
+        "p50": percentile(latencies, 0.5) if latencies else 0.0,
+        "p95": percentile(latencies, 0.95) if latencies else 0.0,
+        "p99": percentile(latencies, 0.99) if latencies else 0.0,
+        "max": latencies[-1] if latencies else 0.0,
+    }
+    return report
+
+
+def format_stream(report: StreamReport):
+    return (
+        f"{report['transactions']} transactions ({report['rows']} rows) in {report['duration']:.1f} s:"
+        f" {report['transactions_per_second']:.1f} transactions/s, {report['rows_per_second']:.1f} rows/s\n"
+        "Commit latency (ms): "
+        + ", ".join(
+            f"{stat} {report[stat] * 1000:.2f}" for stat in ("p50", "p95", "p99", "max")
+        )
+    )
+
+
+__all__ = [
+    "STREAM_TABLES",
+    "STREAM_PARENTS",
+    "StreamOptions",
+    "StreamReport",
+    "positive",
+    "check_stream",
+    "run_stream",
+    "format_stream",
+]
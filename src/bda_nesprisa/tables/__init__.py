@@ -1,5 +1,4 @@
-from typing import Callable, NoReturn, TypedDict
-from tqdm import tqdm
+from typing import Callable, Optional, TypedDict
 from bda_nesprisa.tables.types import (
     TableName,
     Pais,
@@ -41,553 +40,210 @@ from dateutil.relativedelta import relativedelta
 # 4. We use random to generate random values and choice to choose a random value from a list
 from random import choice, randint, random
 
+# 5. Rows are created by the generation engine from the spec of each table (see engine.py)
+from bda_nesprisa.tables.engine import TableSpec, build_table
 
-# DATA GENERATION FUNCTIONS
 
-# We define a function for each table that returns a list of rows for that table
+# KEY SPACES
 
-# Each function has dependency parameters defined as {table_name}_list which will be passed as kwargs
-# and use **_ parameter to ignore any other parameters that we don't need
 
-# We make sure no unique constrainsts are violated by checking the unique keys of the rows that have already been created
-# We use the product function from itertools to generate all the possible combinations of the unique keys
-from itertools import product
+# Faker's date() returns a date between 1970-01-01 and today, so that is the number of different dates
+# that can be part of a primary key (see oferta)
+def num_fake_dates():
+    return (date.today() - date(1970, 1, 1)).days + 1
 
 
-def create_pais(num_rows: int, pbar: tqdm, **_):
-    rows: list[Pais] = []
-    for _ in range(num_rows):
-        rows.append(Pais(id_pais=uuid(), nombre=fake.country()))
-        pbar.update()
-    return rows
+# TABLE SPECS
 
+# We define a spec for each table with its SQLModel class, the number of rows to create and a generator for each
+# column that is not a foreign key (foreign keys are filled by the engine with the keys of the parent rows)
 
-def create_region(pais_list: list[Pais], num_rows: int, pbar: tqdm, **_):
-    rows: list[Region] = []
-    for _ in range(num_rows):
-        rows.append(
-            Region(
-                id_pais=choice([pais.id_pais for pais in pais_list]),
-                id_region=uuid(),
-                nombre=fake.region(),
-            )
-        )
-        pbar.update()
-    return rows
+# Each generator is called with the row built so far and returns the value of its column,
+# so most of them ignore it (_) but some columns depend on others (e.g. end dates after start dates)
 
-
-def create_responsable_plantacion(num_rows: int, pbar: tqdm, **_):
-    rows: list[ResponsablePlantacion] = []
-    for _ in range(num_rows):
-        rows.append(
-            ResponsablePlantacion(
-                dni_responsable=create_dni(),
-                nombre_responsable=fake.name(),
-            )
-        )
-        pbar.update()
-    return rows
-
-
-def create_plantacion(
-    region_list: list[Region],
-    responsable_plantacion_list: list[ResponsablePlantacion],
-    num_rows: int,
-    pbar: tqdm,
-    **_,
-):
-    rows: list[Plantacion] = []
-    possible_uniques = list(
-        product(
-            [(region.id_pais, region.id_region) for region in region_list],
-            [
-                responsable.dni_responsable
-                for responsable in responsable_plantacion_list
-            ],
-        )
-    )
-    for _ in range(num_rows):
-        chosen_unique = choice(
-            [
-                chosen_unique
-                for chosen_unique in possible_uniques
-                if chosen_unique
-                not in [
-                    ((row.id_pais, row.id_region), row.dni_responsable) for row in rows
-                ]
-            ]
-        )
-        rows.append(
-            Plantacion(
-                id_pais=chosen_unique[0][0],
-                id_region=chosen_unique[0][1],
-                id_plantacion=uuid(),
-                direccion=fake.address(),
-                dni_responsable=chosen_unique[1],
-            )
-        )
-        pbar.update()
-    return rows
-
-
-def create_tipo_grano(num_rows: int, pbar: tqdm, **_):
-    rows: list[TipoGrano] = []
-    for _ in range(num_rows):
-        rows.append(TipoGrano(id_tipo_grano=uuid(), descripcion=fake.text()[:100]))
-        pbar.update()
-    return rows
-
-
-def create_grano_en_plantacion(
-    plantacion_list: list[Plantacion],
-    tipo_grano_list: list[TipoGrano],
-    num_rows: int,
-    pbar: tqdm,
-    **_,
-):
-    rows: list[GranoEnPlantacion] = []
-    possible_uniques = list(
-        product(
-            [
-                (plantacion.id_pais, plantacion.id_region, plantacion.id_plantacion)
-                for plantacion in plantacion_list
-            ],
-            [tipo_grano.id_tipo_grano for tipo_grano in tipo_grano_list],
-        )
-    )
-    for _ in range(num_rows):
-        chosen_unique = choice(
-            [
-                chosen_unique
-                for chosen_unique in possible_uniques
-                if chosen_unique
-                not in [
-                    (
-                        (row.id_pais, row.id_region, row.id_plantacion),
-                        row.id_tipo_grano,
-                    )
-                    for row in rows
-                ]
-            ]
-        )
-        rows.append(
-            GranoEnPlantacion(
-                id_pais=chosen_unique[0][0],
-                id_region=chosen_unique[0][1],
-                id_plantacion=chosen_unique[0][2],
-                id_tipo_grano=chosen_unique[1],
-            )
-        )
-        pbar.update()
-    return rows
-
-
-def create_variedad(num_rows: int, pbar: tqdm, **_):
-    rows: list[Variedad] = []
-    for _ in range(num_rows):
-        rows.append(
-            Variedad(
-                id_variedad=uuid(),
-                denominacion=fake.unique.word(),
-                pvp10=random() * 100,
-                intensidad=randint(0, 10),
-                nivel_cafeina=choice([None, "bajo", "medio", "alto"]),
-            )
-        )
-        pbar.update()
-    return rows
-
-
-def create_variedad_especial(
-    variedad_list: list[Variedad], num_rows: int, pbar: tqdm, **_
-):
-    rows: list[VariedadEspecial] = []
-    possible_uniques = [variedad.id_variedad for variedad in variedad_list]
-
-    for _ in range(num_rows):
-        fecha_inicio_disponibilidad = date.fromisoformat(fake.date())
-        fecha_fin_disponibilidad = fecha_inicio_disponibilidad + relativedelta(
-            weeks=+randint(1, 8)
-        )
-        chosen_unique = choice(
-            [
-                chosen_unique
-                for chosen_unique in possible_uniques
-                if chosen_unique not in [row.id_variedad for row in rows]
-            ]
-        )
-
-        rows.append(
-            VariedadEspecial(
-                id_variedad=chosen_unique,
-                descripcion_envase=fake.text()[:100],
-                fecha_inicio_disponibilidad=fecha_inicio_disponibilidad,
-                fecha_fin_disponibilidad=fecha_fin_disponibilidad,
-            )
-        )
-        pbar.update()
-    return rows
-
-
-def create_oferta(variedad_list: list[Variedad], num_rows: int, pbar: tqdm, **_):
-    rows: list[Oferta] = []
-    possible_uniques = [variedad.id_variedad for variedad in variedad_list]
-
-    for _ in range(num_rows):
-        fecha_inicio = date.fromisoformat(fake.date())
-        fecha_fin = fecha_inicio + relativedelta(weeks=+randint(1, 8))
-        chosen_unique = choice(
-            [
-                chosen_unique
-                for chosen_unique in possible_uniques
-                if (chosen_unique, fecha_inicio) not in [(row.id_variedad, row.fecha_inicio) for row in rows]
-            ]
-        )
-
-        rows.append(
-            Oferta(
-                id_variedad=chosen_unique,
-                fecha_inicio=fecha_inicio,
-                fecha_fin=fecha_fin,
-                descuento=random(),
-                fidelidad=choice([None, "I", "II", "III"]),
-            )
-        )
-        pbar.update()
-    return rows
-
-
-def create_aditivo(num_rows: int, pbar: tqdm, **_):
-    rows: list[Aditivo] = []
-    for _ in range(num_rows):
-        rows.append(Aditivo(id_aditivo=uuid(), descripcion=fake.text()[:100]))
-        pbar.update()
-    return rows
-
-
-def create_anyadir(
-    aditivo_list: list[Aditivo],
-    variedad_list: list[Variedad],
-    num_rows: int,
-    pbar: tqdm,
-    **_,
-):
-    rows: list[Anyadir] = []
-    possible_uniques = list(
-        product(
-            [aditivo.id_aditivo for aditivo in aditivo_list],
-            [variedad.id_variedad for variedad in variedad_list],
-        )
-    )
-    for _ in range(num_rows):
-        chosen_unique = choice(
-            [
-                chosen_unique
-                for chosen_unique in possible_uniques
-                if chosen_unique
-                not in [(row.id_aditivo, row.id_variedad) for row in rows]
-            ]
-        )
-        rows.append(
-            Anyadir(
-                id_aditivo=chosen_unique[0],
-                id_variedad=chosen_unique[1],
-                cantidad=random() * choice([1, 10, 100]),
-            )
-        )
-        pbar.update()
-    return rows
-
-
-def create_tienda(num_rows: int, pbar: tqdm, **_):
-    rows: list[Tienda] = []
-    for _ in range(num_rows):
-        rows.append(Tienda(id_tienda=uuid(), direccion=fake.address()[:30]))
-        pbar.update()
-    return rows
-
-
-def create_cliente(num_rows: int, pbar: tqdm, **_):
-    rows: list[Cliente] = []
-    for _ in range(num_rows):
-        rows.append(
-            Cliente(
-                dni=create_dni(),
-                nombre=fake.name(),
-                telefono=fake.phone_number().replace("+34", "").replace(" ", ""),
-                email=fake.email(),
-                fecha=date.fromisoformat(fake.date()),
-            )
-        )
-        pbar.update()
-    return rows
-
-
-def create_carrito(
-    tienda_list: list[Tienda],
-    cliente_list: list[Cliente],
-    num_rows: int,
-    pbar: tqdm,
-    **_,
-):
-    rows: list[Carrito] = []
-    for _ in range(num_rows):
-        rows.append(
-            Carrito(
-                id_tienda=choice(tienda_list).id_tienda,
-                dni_cliente=choice(cliente_list).dni,
-                fecha=date.fromisoformat(fake.date()),
-            )
-        )
-        pbar.update()
-    return rows
-
-
-def create_contiene(
-    carrito_list: list[Carrito],
-    variedad_list: list[Variedad],
-    num_rows: int,
-    pbar: tqdm,
-    **_,
-):
-    rows: list[Contiene] = []
-    possible_uniques = list(
-        product(
-            [(carrito.id_tienda, carrito.id_carrito) for carrito in carrito_list],
-            [variedad.id_variedad for variedad in variedad_list],
-        )
-    )
-    for _ in range(num_rows):
-        chosen_unique = choice(
-            [
-                chosen_unique
-                for chosen_unique in possible_uniques
-                if chosen_unique
-                not in [
-                    ((row.id_tienda, row.id_carrito), row.id_variedad) for row in rows
-                ]
-            ]
-        )
-        rows.append(
-            Contiene(
-                id_tienda=chosen_unique[0][0],
-                id_carrito=chosen_unique[0][1],
-                id_variedad=chosen_unique[1],
-                cantidad=randint(0, 100),
-            )
-        )
-        pbar.update()
-    return rows
-
-
-def create_cafetera(num_rows: int, pbar: tqdm, **_):
-    rows: list[Cafetera] = []
-    for _ in range(num_rows):
-        rows.append(
-            Cafetera(
-                fabricante=fake.company(),
-                modelo=fake.word(),
-                presion=random() * 10,
-            )
-        )
-        pbar.update()
-    return rows
-
-
-def create_tiene_cafetera(
-    cafetera_list: list[Cafetera],
-    cliente_list: list[Cliente],
-    num_rows: int,
-    pbar: tqdm,
-    **_,
-):
-    rows: list[TieneCafetera] = []
-    possible_uniques = list(
-        product(
-            [(cafetera.fabricante, cafetera.modelo) for cafetera in cafetera_list],
-            [cliente.dni for cliente in cliente_list],
-        )
-    )
-    for _ in range(num_rows):
-        chosen_unique = choice(
-            [
-                chosen_unique
-                for chosen_unique in possible_uniques
-                if chosen_unique
-                not in [
-                    ((row.fabricante_caf, row.modelo_caf), row.dni_cliente)
-                    for row in rows
-                ]
-            ]
-        )
-        rows.append(
-            TieneCafetera(
-                fabricante_caf=chosen_unique[0][0],
-                modelo_caf=chosen_unique[0][1],
-                dni_cliente=chosen_unique[1],
-            )
-        )
-        pbar.update()
-    return rows
-
-
-def create_var_en_cafetera(
-    cafetera_list: list[Cafetera],
-    variedad_list: list[Variedad],
-    num_rows: int,
-    pbar: tqdm,
-    **_,
-):
-    rows: list[VarEnCafetera] = []
-    possible_uniques = list(
-        product(
-            [(cafetera.fabricante, cafetera.modelo) for cafetera in cafetera_list],
-            [variedad.id_variedad for variedad in variedad_list],
-        )
-    )
-    for _ in range(num_rows):
-        chosen_unique = choice(
-            [
-                chosen_unique
-                for chosen_unique in possible_uniques
-                if chosen_unique
-                not in [
-                    ((row.fabricante_caf, row.modelo_caf), row.id_variedad)
-                    for row in rows
-                ]
-            ]
-        )
-        rows.append(
-            VarEnCafetera(
-                fabricante_caf=chosen_unique[0][0],
-                modelo_caf=chosen_unique[0][1],
-                id_variedad=chosen_unique[1],
-            )
-        )
-        pbar.update()
-    return rows
-
-
-def create_receta(
-    tipo_grano_list: list[TipoGrano],
-    variedad_list: list[Variedad],
-    num_rows: int,
-    pbar: tqdm,
-    **_,
-):
-    rows: list[Receta] = []
-    possible_uniques = list(
-        product(
-            [tipo_grano.id_tipo_grano for tipo_grano in tipo_grano_list],
-            [variedad.id_variedad for variedad in variedad_list],
-        )
-    )
-    for _ in range(num_rows):
-        chosen_unique = choice(
-            [
-                chosen_unique
-                for chosen_unique in possible_uniques
-                if chosen_unique
-                not in [(row.id_tipo_grano, row.id_variedad) for row in rows]
-            ]
-        )
-        rows.append(
-            Receta(
-                id_tipo_grano=chosen_unique[0],
-                id_variedad=chosen_unique[1],
-                cantidad=random() * 10,
-                nivel_molido=randint(0, 5),
-            )
-        )
-        pbar.update()
-    return rows
-
-
-# We define a dict that for each table contains the function to create the rows
-# and the number of rows to create in order to be able to iterate over it in the main function
 # NOTE: the values of the number of rows to create for each table have been fine-tuned for
 #       the example so the script does not take so long and applying common-sense to the meaning of each table
-CreateRowsDictValue = TypedDict(
-    "CreateRowsDictValue", {"fn": Callable, "num_rows": int}
-)
-create_rows: dict[TableName, CreateRowsDictValue] = {
+table_specs: dict[TableName, TableSpec] = {
     "pais": {
-        "fn": create_pais,
+        "model": Pais,
         "num_rows": 100,
+        "columns": {
+            "id_pais": lambda _: uuid(),
+            "nombre": lambda _: fake.country(),
+        },
     },
     "region": {
-        "fn": create_region,
+        "model": Region,
         "num_rows": 200,
+        "columns": {
+            "id_region": lambda _: uuid(),
+            "nombre": lambda _: fake.region(),
+        },
     },
     "responsable_plantacion": {
-        "fn": create_responsable_plantacion,
+        "model": ResponsablePlantacion,
         "num_rows": 100,
+        "columns": {
+            "dni_responsable": lambda _: create_dni(),
+            "nombre_responsable": lambda _: fake.name(),
+        },
     },
+    # A responsable can only be in charge of one plantacion of each region
     "plantacion": {
-        "fn": create_plantacion,
+        "model": Plantacion,
         "num_rows": 10,
+        "columns": {
+            "id_plantacion": lambda _: uuid(),
+            "direccion": lambda _: fake.address(),
+        },
+        "unique": ("id_pais", "id_region", "dni_responsable"),
     },
     "tipo_grano": {
-        "fn": create_tipo_grano,
+        "model": TipoGrano,
         "num_rows": 10,
+        "columns": {
+            "id_tipo_grano": lambda _: uuid(),
+            "descripcion": lambda _: fake.text()[:100],
+        },
     },
     "grano_en_plantacion": {
-        "fn": create_grano_en_plantacion,
+        "model": GranoEnPlantacion,
         "num_rows": 50,
+        "columns": {},
     },
+    # The denominations are unique words, and Faker gives up after 1000 tries to find an unused one,
+    # so we only allow up to half of the words in Faker's list (then a try fails with probability at most 1/2)
     "variedad": {
-        "fn": create_variedad,
+        "model": Variedad,
         "num_rows": 20,
+        "columns": {
+            "id_variedad": lambda _: uuid(),
+            "denominacion": lambda _: fake.unique.word(),
+            "pvp10": lambda _: random() * 100,
+            "intensidad": lambda _: randint(0, 10),
+            "nivel_cafeina": lambda _: choice([None, "bajo", "medio", "alto"]),
+        },
+        "max_rows": lambda: len(set(fake.get_words_list())) // 2,
     },
     "variedad_especial": {
-        "fn": create_variedad_especial,
+        "model": VariedadEspecial,
         "num_rows": 5,
+        "columns": {
+            "descripcion_envase": lambda _: fake.text()[:100],
+            "fecha_inicio_disponibilidad": lambda _: date.fromisoformat(fake.date()),
+            "fecha_fin_disponibilidad": lambda row: row["fecha_inicio_disponibilidad"]
+            + relativedelta(weeks=+randint(1, 8)),
+        },
     },
     "oferta": {
-        "fn": create_oferta,
+        "model": Oferta,
         "num_rows": 50,
+        "columns": {
+            "fecha_inicio": lambda _: date.fromisoformat(fake.date()),
+            "fecha_fin": lambda row: row["fecha_inicio"]
+            + relativedelta(weeks=+randint(1, 8)),
+            "descuento": lambda _: random(),
+            "fidelidad": lambda _: choice([None, "I", "II", "III"]),
+        },
+        "sizes": {"fecha_inicio": num_fake_dates},
     },
     "aditivo": {
-        "fn": create_aditivo,
+        "model": Aditivo,
         "num_rows": 3,
+        "columns": {
+            "id_aditivo": lambda _: uuid(),
+            "descripcion": lambda _: fake.text()[:100],
+        },
     },
     "anyadir": {
-        "fn": create_anyadir,
+        "model": Anyadir,
         "num_rows": 10,
+        "columns": {
+            "cantidad": lambda _: random() * choice([1, 10, 100]),
+        },
     },
     "tienda": {
-        "fn": create_tienda,
+        "model": Tienda,
         "num_rows": 50,
+        "columns": {
+            "id_tienda": lambda _: uuid(),
+            "direccion": lambda _: fake.address()[:30],
+        },
     },
     "cliente": {
-        "fn": create_cliente,
+        "model": Cliente,
         "num_rows": 50,
-    },
+        "columns": {
+            "dni": lambda _: create_dni(),
+            "nombre": lambda _: fake.name(),
+            "telefono": lambda _: fake.phone_number()
+            .replace("+34", "")
+            .replace(" ", ""),
+            "email": lambda _: fake.email(),
+            "fecha": lambda _: date.fromisoformat(fake.date()),
+        },
+    },
+    # The id_carrito is assigned by the database
     "carrito": {
-        "fn": create_carrito,
+        "model": Carrito,
         "num_rows": 50,
+        "columns": {
+            "fecha": lambda _: date.fromisoformat(fake.date()),
+        },
     },
     "contiene": {
-        "fn": create_contiene,
+        "model": Contiene,
         "num_rows": 200,
+        "columns": {
+            "cantidad": lambda _: randint(0, 100),
+        },
     },
     "cafetera": {
-        "fn": create_cafetera,
+        "model": Cafetera,
         "num_rows": 30,
+        "columns": {
+            "fabricante": lambda _: fake.company(),
+            "modelo": lambda _: fake.word(),
+            "presion": lambda _: random() * 10,
+        },
     },
     "tiene_cafetera": {
-        "fn": create_tiene_cafetera,
+        "model": TieneCafetera,
         "num_rows": 200,
+        "columns": {},
     },
     "var_en_cafetera": {
-        "fn": create_var_en_cafetera,
+        "model": VarEnCafetera,
         "num_rows": 200,
+        "columns": {},
     },
     "receta": {
-        "fn": create_receta,
+        "model": Receta,
         "num_rows": 100,
+        "columns": {
+            "cantidad": lambda _: random() * 10,
+            "nivel_molido": lambda _: randint(0, 5),
+        },
+    },
+}
+
+
+# We define a dict that for each table contains the function to create the rows,
+# the number of rows to create in order to be able to iterate over it in the main function
+# and a function that, given the number of rows of every table, returns how many different unique keys
+# the table can have (or None if it is practically unbounded, e.g. keys made with uuid), which is used by the planner
+# All of them are built by the generation engine from the table specs
+CreateRowsDictValue = TypedDict(
+    "CreateRowsDictValue",
+    {
+        "fn": Callable,
+        "num_rows": int,
+        "key_space": Callable[[dict[TableName, int]], Optional[int]],
     },
+)
+create_rows: dict[TableName, CreateRowsDictValue] = {
+    table: build_table(spec) for table, spec in table_specs.items()
 }
 
-# We only export the create_rows dict since we don't want to expose the create_rows functions outside
-__all__ = ["create_rows"]
+# We only export the create_rows dict and the table specs since we don't want to expose the rest outside
+__all__ = ["create_rows", "table_specs"]
@@ -0,0 +1,271 @@
+from hashlib import blake2b
+from math import prod
+from random import choice, getrandbits
+from typing import Any, Callable, NamedTuple, Optional, TypedDict
+from sqlmodel import SQLModel
+from tqdm import tqdm
+from bda_nesprisa.tables.keystore import KeyBudget, KeyStore
+from bda_nesprisa.tables.types import TableName
+
+# GENERATION ENGINE
+
+# Instead of writing a function for each table, every table is described by a spec with its SQLModel class and
+# a generator for each of its columns that is not taken from a parent table, and the engine builds from it
+# the function that creates the rows and the function that computes its key space
+
+# The engine reads the primary key and the foreign keys from the SQLModel class:
+# 1. Foreign key columns that reference the same parent row are grouped, so their values are taken together from
+#    one row of the parent (e.g. id_pais and id_region of a plantacion come from the same region)
+# 2. The unique key of the table (the primary key unless the spec says otherwise) is enforced:
+#    - if it is only made of foreign key groups, we sample without replacement from the product of the parent rows,
+#      which never repeats a key and doesn't have to look at the rows already created
+#    - if it also has generated columns with a known number of values (e.g. dates), we generate rows and discard
+#      the ones whose key was already used
+#    - if it has generated columns with practically unbounded values (e.g. uuid) or assigned by the database,
+#      there is nothing to enforce
+# 3. The rows of the parent tables are given as key stores (see keystore.py), which may be spilled to disk,
+#    so the engine only reads the keys it needs from them instead of copying them
+# 4. The rows are created lazily, as the caller iterates over them, so a table is never kept whole in memory
+#    (e.g. the main function loads them in batches and only keeps their keys)
+
+
+class TableSpecRequired(TypedDict):
+    model: type[SQLModel]
+    num_rows: int
+    # Generator for each column not taken from a parent, in order, called with the row built so far
+    # (foreign key columns first) so a column can depend on the previous ones
+    columns: dict[str, Callable[[dict[str, Any]], Any]]
+
+
+class TableSpec(TableSpecRequired, total=False):
+    # Columns whose combination has to be unique, if they are not the primary key
+    unique: tuple[str, ...]
+    # Number of different values of generated columns that are part of the unique key
+    sizes: dict[str, Callable[[], int]]
+    # Maximum number of rows the generators can create (e.g. because they use Faker's unique values)
+    max_rows: Callable[[], int]
+
+
+class ForeignKeyGroup(NamedTuple):
+    table: TableName
+    columns: tuple[str, ...]
+    parent_columns: tuple[str, ...]
+
+
+# Number of rows created between progress bar updates
+BATCH_SIZE = 1000
+# Rounds of the Feistel network of a RandomPermutation
+ROUNDS = 4
+
+
+def primary_key(model: type[SQLModel]):
+    return tuple(column.name for column in model.__table__.primary_key.columns)
+
+
+# Tables referenced by the foreign keys of a table
+def parent_tables(model: type[SQLModel]) -> set[TableName]:
+    return {
+        foreign_key.target_fullname.split(".")[0]
+        for foreign_key in model.__table__.foreign_keys
+    }
+
+
+def foreign_key_groups(model: type[SQLModel]):
+    table = model.__table__
+
+    # 1. Group the foreign key columns by the table they reference
+    #    (in the order of the columns, since the foreign keys are a set and seeded runs need always the same order)
+    groups: dict[TableName, dict[str, str]] = {}
+    for column in table.columns:
+        for foreign_key in sorted(
+            column.foreign_keys, key=lambda foreign_key: foreign_key.target_fullname
+        ):
+            parent, parent_column = foreign_key.target_fullname.split(".")
+            groups.setdefault(parent, {})[column.name] = parent_column
+
+    # 2. A foreign key may only reference part of the primary key of its parent (e.g. plantacion.id_region
+    #    references region.id_region but region's primary key is id_pais and id_region), so we add the columns
+    #    of the table that are named like the rest of the parent's primary key
+    for parent, columns in groups.items():
+        for parent_column in SQLModel.metadata.tables[parent].primary_key.columns:
+            if (
+                parent_column.name not in columns.values()
+                and parent_column.name in table.columns
+            ):
+                columns[parent_column.name] = parent_column.name
+
+    # 3. Groups contained in other groups reference an ancestor whose key is already taken from the other parent
+    #    (e.g. plantacion.id_pais comes from the region, not from a random pais)
+    return [
+        ForeignKeyGroup(parent, tuple(columns), tuple(columns.values()))
+        for parent, columns in groups.items()
+        if not any(
+            other is not columns and set(columns) < set(other)
+            for other in groups.values()
+        )
+    ]
+
+
+def unique_key(spec: TableSpec):
+    return spec.get("unique", primary_key(spec["model"]))
+
+
+# Returns the foreign key groups that are part of the unique key and the generated unique columns,
+# or None if the unique key has columns with practically unbounded values and doesn't need to be enforced
+def unique_parts(spec: TableSpec, groups: list[ForeignKeyGroup]):
+    unique = set(unique_key(spec))
+    unique_groups = [group for group in groups if unique & set(group.columns)]
+    generated = unique - {column for group in unique_groups for column in group.columns}
+    sizes = spec.get("sizes", {})
+    # Besides, if only part of a group is unique, different parent rows can give the same key
+    if any(column not in sizes for column in generated) or any(
+        not set(group.columns) <= unique for group in unique_groups
+    ):
+        return None
+    return unique_groups, generated
+
+
+# Pseudo-random permutation of range(size) that computes the n-th value without keeping the rest, so we can sample
+# without replacement from huge key spaces in constant memory (random.sample keeps a list with every sampled value)
+# It is a Feistel network over the smallest even number of bits that fits size, whose round keys are drawn from
+# the random module (so seeded runs give the same permutation), and values out of range are permuted again
+# until they are in range, which takes less than 4 tries on average
+class RandomPermutation:
+    def __init__(self, size: int):
+        self.size = size
+        self.half = (max(size - 1, 1).bit_length() + 1) // 2
+        self.mask = (1 << self.half) - 1
+        self.num_bytes = (self.half + 7) // 8
+        self.keys = [getrandbits(64).to_bytes(8, "little") for _ in range(ROUNDS)]
+
+    def round(self, key: bytes, value: int):
+        digest = blake2b(
+            value.to_bytes(self.num_bytes, "little"),
+            digest_size=min(self.num_bytes, 64),
+            key=key,
+        ).digest()
+        return int.from_bytes(digest, "little") & self.mask
+
+    def __getitem__(self, index: int):
+        while True:
+            left, right = index >> self.half, index & self.mask
+            for key in self.keys:
+                left, right = right, left ^ self.round(key, right)
+            index = (left << self.half) | right
+            if index < self.size:
+                return index
+
+
+def create_fn(spec: TableSpec):
+    model = spec["model"]
+    columns = spec["columns"]
+    unique = unique_key(spec)
+    groups = foreign_key_groups(model)
+    parts = unique_parts(spec, groups)
+
+    def create(
+        num_rows: int,
+        pbar: tqdm,
+        key_budget: Optional[KeyBudget] = None,
+        **rows_list: KeyStore,
+    ):
+        # Keys of the parent rows referenced by each foreign key group
+        parent_keys = {
+            group.table: rows_list[f"{group.table}_list"].project(group.parent_columns)
+            for group in groups
+        }
+
+        # When the unique key is only made of foreign key groups, their parent rows are sampled without replacement
+        # from their product, decoding each sampled index as a mixed-radix number with a digit per group,
+        # and the parent rows of the rest of groups are chosen at random for every row
+        sampled = parts is not None and not parts[1]
+        if sampled:
+            unique_groups = parts[0]
+            radixes = [len(parent_keys[group.table]) for group in unique_groups]
+            indexes = RandomPermutation(prod(radixes))
+        free_groups = [
+            group for group in groups if not sampled or group not in unique_groups
+        ]
+
+        # Keys already used, when the unique key has generated columns
+        checked = parts is not None and bool(parts[1])
+        if checked:
+            seen = KeyStore(model, unique, key_budget)
+
+        created = 0
+        try:
+            while created < num_rows:
+                batch_start = created
+                while created < min(batch_start + BATCH_SIZE, num_rows):
+                    row: dict[str, Any] = {}
+                    if sampled:
+                        index = indexes[created]
+                        for group, radix in zip(unique_groups, radixes):
+                            index, digit = divmod(index, radix)
+                            row.update(
+                                zip(group.columns, parent_keys[group.table][digit])
+                            )
+                    for group in free_groups:
+                        row.update(zip(group.columns, choice(parent_keys[group.table])))
+                    for column, generator in columns.items():
+                        row[column] = generator(row)
+
+                    # Keys with generated columns are only known after generating the row, so we discard
+                    # repeated ones
+                    if checked:
+                        key = tuple(row[column] for column in unique)
+                        if key in seen:
+                            continue
+                        seen.append_key(key)
+
+                    created += 1
+                    yield model(**row)
+                pbar.update(created - batch_start)
+        finally:
+            if checked:
+                seen.close()
+
+    return create
+
+
+# Returns the function that, given the number of rows of every table, returns how many different unique keys
+# the table can have (or None if it is practically unbounded)
+def key_space_fn(spec: TableSpec):
+    groups = foreign_key_groups(spec["model"])
+    parts = unique_parts(spec, groups)
+    max_rows = spec.get("max_rows")
+
+    def key_space(counts: dict[TableName, int]) -> Optional[int]:
+        # Every row takes its foreign keys from a parent row, so no row can be created if a parent table is empty,
+        # even when the rest of the key is practically unbounded
+        if any(not counts[group.table] for group in groups):
+            return 0
+        if parts is None:
+            return None if max_rows is None else max_rows()
+        unique_groups, generated = parts
+        space = prod(counts[group.table] for group in unique_groups) * prod(
+            spec["sizes"][column]() for column in generated
+        )
+        return space if max_rows is None else min(space, max_rows())
+
+    return key_space
+
+
+# Builds the values of the create_rows dict used by the main function from a table spec
+def build_table(spec: TableSpec):
+    return {
+        "fn": create_fn(spec),
+        "num_rows": spec["num_rows"],
+        "key_space": key_space_fn(spec),
+    }
+
+
+__all__ = [
+    "TableSpec",
+    "ForeignKeyGroup",
+    "RandomPermutation",
+    "primary_key",
+    "parent_tables",
+    "foreign_key_groups",
+    "build_table",
+]
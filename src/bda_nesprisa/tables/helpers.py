@@ -1,5 +1,4 @@
-from random import choice, randint
-from uuid import uuid4
+from random import choice, getrandbits, randint
 
 
 def create_dni():
@@ -8,5 +7,7 @@ def create_dni():
     )
 
 
+# We take the random bits from the random module instead of uuid4 so the ids can be reproduced by seeding it
+# (60 random bits are 15 hex characters, the same length as the ids we took from uuid4)
 def uuid():
-    return uuid4().hex[:15]
+    return f"{getrandbits(60):015x}"
@@ -0,0 +1,439 @@
+import mmap
+import struct
+import sys
+import weakref
+from collections import namedtuple
+from collections.abc import Sequence
+from datetime import date
+from itertools import islice
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Iterable, Literal, Optional
+from sqlalchemy import Date, Integer, String
+from sqlmodel import SQLModel
+
+# KEY STORES
+
+# Every table needs the keys of the rows of its parents (e.g. tiene_cafetera needs the dni of every cliente), and with
+# very large tables they don't fit in memory, so the rows of each table are kept in a KeyStore:
+# 1. It only keeps the primary and foreign key columns of each row, as a named tuple (so row.dni_cliente still works)
+# 2. The keys are kept in a list until the estimated memory of all the stores of a KeyBudget exceeds its maximum,
+#    then the biggest stores are spilled to a file on disk with a fixed-width record for each key, which is
+#    memory-mapped so the operating system pages it in and out instead of it counting as memory of the process
+# 3. Spilled stores still support what the generation engine needs: their length, random access to the n-th key
+#    (so random.choice and sample work the same and seeded runs give the same rows) and membership checks,
+#    with an open addressing hash index in another memory-mapped file built the first time it is needed
+# Records are packed with struct: a flag for NULL and the value of each column, with strings encoded in UTF-8 and
+# padded to a fixed width, integers as 64-bit integers and dates as their ordinal
+# NOTE: the widths of the strings are chosen when spilling from the longest ones, so if a longer one comes later
+#       the file is rewritten with wider records
+
+ColumnKind = Literal["str", "int", "date"]
+
+# Minimum number of records of a file and of slots of its index
+MIN_CAPACITY = 1024
+# Minimum width in bytes of a string column in a file
+MIN_STRING_WIDTH = 16
+# Estimated bytes of each key in the membership set of a store in memory
+MEMBER_MEMORY = 32
+# Keys added between checks of the budget when extending a store
+CHUNK_SIZE = 10_000
+
+
+# Primary and foreign key columns of a table, in the order of the columns, which are the ones other tables
+# and the rest of modes need from its rows
+def key_columns(model: type[SQLModel]):
+    return tuple(
+        column.name
+        for column in model.__table__.columns
+        if column.primary_key or column.foreign_keys
+    )
+
+
+# Kind of value of a column (SQLModel wraps strings in an AutoString type whose impl is the String),
+# or None if keys can't have it
+def column_kind(column) -> Optional[ColumnKind]:
+    column_type = getattr(column.type, "impl", column.type)
+    if isinstance(column_type, String):
+        return "str"
+    if isinstance(column_type, Integer):
+        return "int"
+    if isinstance(column_type, Date):
+        return "date"
+    return None
+
+
+class KeyBudget:
+    def __init__(self, max_memory: int, directory: Optional[str] = None):
+        self.max_memory = max_memory
+        # Without a directory the files are written to a temporary one that is deleted at the end
+        self.temporary = None
+        if directory is None:
+            self.temporary = TemporaryDirectory(prefix="bda_nesprisa_keys_")
+            directory = self.temporary.name
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.stores: weakref.WeakSet[KeyStore] = weakref.WeakSet()
+        self.memory = 0
+        self.files = 0
+
+    def path(self, name: str):
+        self.files += 1
+        return self.directory / f"{name}.{self.files}.keys"
+
+    # Adds the estimated memory of new keys and spills the biggest stores until we are within the budget
+    def charge(self, memory: int):
+        self.memory += memory
+        while self.memory > self.max_memory:
+            biggest = max(
+                (store for store in self.stores if store.keys is not None),
+                key=lambda store: store.memory,
+                default=None,
+            )
+            if biggest is None or not biggest.memory:
+                break
+            biggest.spill()
+
+
+class KeyFile:
+    def __init__(
+        self, path: Path, kinds: list[ColumnKind], widths: list[int], capacity: int
+    ):
+        self.path = path
+        self.kinds = kinds
+        self.widths = widths
+        self.struct = struct.Struct(
+            "="
+            + "".join(
+                f"?{width}s" if kind == "str" else "?q"
+                for kind, width in zip(kinds, widths)
+            )
+        )
+        self.count = 0
+        self.capacity = max(capacity, MIN_CAPACITY)
+        self.file = open(path, "w+b")
+        self.file.truncate(self.capacity * self.struct.size)
+        self.data = mmap.mmap(self.file.fileno(), self.capacity * self.struct.size)
+
+        # Hash index: each slot has 0 if it is empty or the position of a record plus 1
+        self.index_file = None
+        self.index = None
+        self.slots = None
+
+    # Whether the strings of a key fit in the widths of the file
+    def fits(self, key: tuple):
+        return all(
+            kind != "str" or value is None or len(value.encode()) <= width
+            for kind, width, value in zip(self.kinds, self.widths, key)
+        )
+
+    def pack(self, key: tuple):
+        values: list[Any] = []
+        for kind, value in zip(self.kinds, key):
+            if value is None:
+                values.extend((False, b"" if kind == "str" else 0))
+            elif kind == "str":
+                values.extend((True, value.encode()))
+            elif kind == "date":
+                values.extend((True, value.toordinal()))
+            else:
+                values.extend((True, value))
+        return self.struct.pack(*values)
+
+    def unpack(self, values: tuple):
+        key = []
+        for index, kind in enumerate(self.kinds):
+            present, value = values[2 * index], values[2 * index + 1]
+            if not present:
+                key.append(None)
+            elif kind == "str":
+                key.append(value.rstrip(b"\0").decode())
+            elif kind == "date":
+                key.append(date.fromordinal(value))
+            else:
+                key.append(value)
+        return key
+
+    def __getitem__(self, position: int):
+        return self.unpack(
+            self.struct.unpack_from(self.data, position * self.struct.size)
+        )
+
+    def record(self, position: int):
+        size = self.struct.size
+        return self.data[position * size : (position + 1) * size]
+
+    # The file grows by doubling its capacity, so appending is amortized constant time
+    def append(self, key: tuple):
+        if self.count == self.capacity:
+            self.capacity *= 2
+            self.data.close()
+            self.file.truncate(self.capacity * self.struct.size)
+            self.data = mmap.mmap(self.file.fileno(), self.capacity * self.struct.size)
+        packed = self.pack(key)
+        self.data[
+            self.count * self.struct.size : (self.count + 1) * self.struct.size
+        ] = packed
+        self.count += 1
+        if self.slots is not None:
+            # The index is kept at most half full so probes stay short
+            if 2 * self.count > len(self.slots):
+                self.build_index()
+            else:
+                slot, found = self.find(packed)
+                if not found:
+                    self.slots[slot] = self.count
+
+    # Returns the slot of a packed key in the index and whether it is there (or the empty slot where it would go)
+    def find(self, packed: bytes):
+        mask = len(self.slots) - 1
+        slot = hash(packed) & mask
+        while True:
+            position = self.slots[slot]
+            if not position:
+                return slot, False
+            if self.record(position - 1) == packed:
+                return slot, True
+            slot = (slot + 1) & mask
+
+    def build_index(self):
+        self.close_index()
+        num_slots = MIN_CAPACITY
+        while num_slots < 4 * self.count:
+            num_slots *= 2
+        self.index_file = open(self.path.with_suffix(".index"), "w+b")
+        self.index_file.truncate(num_slots * 8)
+        self.index = mmap.mmap(self.index_file.fileno(), num_slots * 8)
+        self.slots = memoryview(self.index).cast("q")
+        for position in range(self.count):
+            slot, found = self.find(self.record(position))
+            if not found:
+                self.slots[slot] = position + 1
+
+    def __contains__(self, key: tuple):
+        if not self.fits(key):
+            return False
+        if self.slots is None:
+            self.build_index()
+        return self.find(self.pack(key))[1]
+
+    def close_index(self):
+        if self.slots is not None:
+            self.slots.release()
+            self.index.close()
+            self.index_file.close()
+            self.path.with_suffix(".index").unlink()
+            self.slots = self.index = self.index_file = None
+
+    def close(self):
+        self.close_index()
+        self.data.close()
+        self.file.close()
+        self.path.unlink()
+
+
+class KeyStore(Sequence):
+    def __init__(
+        self,
+        model: type[SQLModel],
+        columns: Optional[Iterable[str]] = None,
+        budget: Optional[KeyBudget] = None,
+    ):
+        self.name = model.__tablename__
+        self.columns = key_columns(model) if columns is None else tuple(columns)
+        self.record = namedtuple(self.name, self.columns)
+        self.kinds: list[ColumnKind] = []
+        for column in self.columns:
+            kind = column_kind(model.__table__.c[column])
+            if kind is None:
+                raise TypeError(
+                    f"Column {self.name}.{column} can't be part of a key store"
+                )
+            self.kinds.append(kind)
+
+        self.budget = budget
+        if budget is not None:
+            budget.stores.add(self)
+
+        # Keys in memory (None once spilled), set of them for membership checks (built the first time one is done)
+        # and their estimated memory
+        self.keys: Optional[list] = []
+        self.members: Optional[set] = None
+        self.memory = 0
+        self.key_memory: Optional[int] = None
+
+        self.file: Optional[KeyFile] = None
+
+    def __len__(self):
+        return len(self.keys) if self.keys is not None else self.file.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return KeyView(self, range(len(self))[index])
+        if self.keys is not None:
+            return self.keys[index]
+        if index < 0:
+            index += self.file.count
+        if not 0 <= index < self.file.count:
+            raise IndexError("key store index out of range")
+        return self.record._make(self.file[index])
+
+    def __iter__(self):
+        if self.keys is not None:
+            return iter(self.keys)
+        return (self[index] for index in range(len(self)))
+
+    def __contains__(self, key):
+        if self.keys is not None and self.members is None:
+            self.members = set(self.keys)
+            # The memory of the set can exceed the budget and spill this same store
+            self.charge(len(self.keys) * MEMBER_MEMORY)
+        if self.keys is None:
+            return tuple(key) in self.file
+        return key in self.members
+
+    # View of some columns of the keys, in the given order
+    def project(self, columns: Iterable[str]):
+        columns = tuple(columns)
+        if columns == self.columns:
+            return self
+        return KeyView(
+            self, range(len(self)), [self.columns.index(column) for column in columns]
+        )
+
+    def charge(self, memory: int):
+        self.memory += memory
+        if self.budget is not None:
+            self.budget.charge(memory)
+
+    def append_key(self, key: tuple):
+        if self.keys is None:
+            self.append_to_file(key)
+            return
+        record = self.record._make(key)
+        self.keys.append(record)
+        if self.members is not None:
+            self.members.add(record)
+        self.charge(self.estimate(record))
+
+    # Adds the keys of some rows (e.g. SQLModel instances or the records of another store)
+    def extend(self, rows: Iterable[Any]):
+        self.extend_keys(
+            tuple(getattr(row, column) for column in self.columns) for row in rows
+        )
+
+    def extend_keys(self, keys: Iterable[tuple]):
+        keys = iter(keys)
+        while chunk := list(islice(keys, CHUNK_SIZE)):
+            if self.keys is None:
+                for key in chunk:
+                    self.append_to_file(key)
+                continue
+            records = list(map(self.record._make, chunk))
+            self.keys.extend(records)
+            if self.members is not None:
+                self.members.update(records)
+            self.charge(len(records) * self.estimate(records[0]))
+
+    # Estimated memory of a key in the list (and in the membership set, if any), from the first one
+    def estimate(self, record: tuple):
+        if self.key_memory is None:
+            self.key_memory = (
+                sys.getsizeof(record)
+                + sum(sys.getsizeof(value) for value in record)
+                # Slot of the list
+                + 8
+            )
+        return self.key_memory + (MEMBER_MEMORY if self.members is not None else 0)
+
+    def spill(self):
+        keys = self.keys
+        self.file = KeyFile(
+            self.budget.path(self.name), self.kinds, self.widths(keys), len(keys)
+        )
+        for key in keys:
+            self.file.append(key)
+        if self.members is not None:
+            self.file.build_index()
+        self.keys = None
+        self.members = None
+        if self.budget is not None:
+            self.budget.memory -= self.memory
+        self.memory = 0
+
+    # Widths of the strings of a file for some keys, starting from the given ones, so the longest string of each
+    # column fits (rounded up to a power of two)
+    def widths(self, keys: Iterable[tuple], widths: Optional[list[int]] = None):
+        widths = list(widths or [MIN_STRING_WIDTH] * len(self.columns))
+        for key in keys:
+            for index, (kind, value) in enumerate(zip(self.kinds, key)):
+                if kind == "str" and value is not None:
+                    while len(value.encode()) > widths[index]:
+                        widths[index] *= 2
+        return widths
+
+    def append_to_file(self, key: tuple):
+        if not self.file.fits(key):
+            # Rewrite the file with strings wide enough for the new key, copying the records one by one
+            old = self.file
+            self.file = KeyFile(
+                self.budget.path(self.name),
+                self.kinds,
+                self.widths([key], old.widths),
+                old.count + 1,
+            )
+            for position in range(old.count):
+                self.file.append(old[position])
+            if old.slots is not None:
+                self.file.build_index()
+            old.close()
+        self.file.append(key)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.budget is not None:
+            self.budget.memory -= self.memory
+            self.budget.stores.discard(self)
+        self.keys = []
+        self.members = None
+        self.memory = 0
+
+
+# Part of the keys of a store (e.g. the share of a shard), optionally with only some of its columns
+class KeyView(Sequence):
+    def __init__(
+        self, store: KeyStore, indexes: range, columns: Optional[list[int]] = None
+    ):
+        self.store = store
+        self.indexes = indexes
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return KeyView(self.store, self.indexes[index], self.columns)
+        key = self.store[self.indexes[index]]
+        if self.columns is None:
+            return key
+        return tuple(key[column] for column in self.columns)
+
+    def project(self, columns: Iterable[str]):
+        return KeyView(
+            self.store,
+            self.indexes,
+            [self.store.columns.index(column) for column in columns],
+        )
+
+
+__all__ = [
+    "CHUNK_SIZE",
+    "key_columns",
+    "column_kind",
+    "KeyBudget",
+    "KeyStore",
+    "KeyView",
+]
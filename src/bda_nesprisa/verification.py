@@ -0,0 +1,183 @@
+import sqlite3
+from datetime import date
+from hashlib import md5
+from typing import Iterable, Optional
+from sqlalchemy import Integer, and_, event, exists, func
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+from sqlmodel import Session, SQLModel, select
+from bda_nesprisa.tables.engine import foreign_key_groups, primary_key
+from bda_nesprisa.tables.keystore import column_kind
+from bda_nesprisa.tables.types import TableName
+
+# VERIFICATION
+
+# After loading each table we check with a few aggregate queries that its rows landed, instead of refreshing
+# every row (which costs a query per row):
+# 1. While loading, the loader keeps in memory the number of rows and a checksum of each of their primary key columns
+#    (the sum of a hash of the value of the column in each row, see key_hash)
+# 2. Before and after loading, one query computes the same count and checksum in the database,
+#    and the difference has to be what we loaded
+# 3. For each foreign key group, one anti-join query counts the rows whose parent row doesn't exist,
+#    which has to be 0
+# If anything doesn't match, the run fails with a VerificationError
+# NOTE: the sums of the hashes detect lost, duplicated and changed keys, but as any checksum they could miss
+#       changes that cancel each other out
+
+
+class VerificationError(RuntimeError):
+    pass
+
+
+# The hash of a key value is the first 32 bits of the MD5 of its text (dates in ISO format), which we can compute
+# the same way in Python, in Oracle (with STANDARD_HASH) and in SQLite (with a function registered on connect)
+def hash_value(value):
+    if isinstance(value, date):
+        value = value.isoformat()
+    return int(md5(str(value).encode()).hexdigest()[:8], 16)
+
+
+class key_hash(FunctionElement):
+    type = Integer()
+    inherit_cache = True
+
+
+@compiles(key_hash)
+def compile_key_hash(element, compiler, **kw):
+    return f"key_hash({compiler.process(element.clauses, **kw)})"
+
+
+@compiles(key_hash, "oracle")
+def compile_key_hash_oracle(element, compiler, **kw):
+    (column,) = element.clauses.clauses
+    text = compiler.process(column, **kw)
+    if column_kind(column) == "int":
+        text = f"TO_CHAR({text})"
+    elif column_kind(column) == "date":
+        text = f"TO_CHAR({text}, 'YYYY-MM-DD')"
+    return (
+        f"TO_NUMBER(SUBSTR(RAWTOHEX(STANDARD_HASH({text}, 'MD5')), 1, 8), 'XXXXXXXX')"
+    )
+
+
+# SQLite stores dates as ISO text, so the function only has to hash the text of the value
+@event.listens_for(Engine, "connect")
+def register_key_hash(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function(
+            "key_hash",
+            1,
+            lambda value: None if value is None else hash_value(value),
+            deterministic=True,
+        )
+
+
+# Primary key columns that are part of the checksum
+def checksum_columns(model: type[SQLModel]):
+    table = model.__table__
+    return [name for name in primary_key(model) if column_kind(table.c[name])]
+
+
+class Checksum:
+    def __init__(self, model: type[SQLModel]):
+        self.columns = checksum_columns(model)
+        self.count = 0
+        self.sums = [0] * len(self.columns)
+
+    # Adds rows once they are flushed, so the values assigned by the database (e.g. carrito ids) are known
+    def add(self, rows: Iterable[SQLModel]):
+        for row in rows:
+            self.count += 1
+            for index, name in enumerate(self.columns):
+                value = getattr(row, name)
+                if value is not None:
+                    self.sums[index] += hash_value(value)
+
+    def values(self):
+        return (self.count, *self.sums)
+
+
+# Count and checksum of all the rows of a table in the database
+# (using execute instead of exec, which would return a single value instead of a tuple for tables without checksum)
+def aggregates(session: Session, model: type[SQLModel]):
+    table = model.__table__
+    row = session.execute(
+        select(
+            func.count(),
+            *(
+                func.coalesce(func.sum(key_hash(table.c[name])), 0)
+                for name in checksum_columns(model)
+            ),
+        ).select_from(model)
+    ).one()
+    return tuple(int(value) for value in row)
+
+
+# Number of rows of a table whose parent row doesn't exist, for each foreign key group
+def orphans(session: Session, model: type[SQLModel], parents: Iterable[TableName]):
+    table = model.__table__
+    counts: dict[TableName, int] = {}
+    for group in foreign_key_groups(model):
+        if group.table not in parents:
+            continue
+        parent = SQLModel.metadata.tables[group.table]
+        counts[group.table] = session.exec(
+            select(func.count())
+            .select_from(table)
+            .where(
+                *(table.c[column].isnot(None) for column in group.columns),
+                ~exists().where(
+                    and_(
+                        *(
+                            parent.c[parent_column] == table.c[column]
+                            for column, parent_column in zip(
+                                group.columns, group.parent_columns
+                            )
+                        )
+                    )
+                ),
+            )
+        ).one()
+    return counts
+
+
+# Checks a table after loading it, given the aggregates before loading it (None to skip the count and checksum)
+# and the parent tables whose foreign keys have to be checked
+def verify_table(
+    session: Session,
+    table: TableName,
+    model: type[SQLModel],
+    checksum: Checksum,
+    before: Optional[tuple[int, ...]],
+    parents: Iterable[TableName],
+):
+    errors = []
+
+    if before is not None:
+        after = aggregates(session, model)
+        loaded = tuple(a - b for a, b in zip(after, before))
+        if loaded[0] != checksum.count:
+            errors.append(
+                f"{checksum.count} rows were loaded but the table has {loaded[0]} more rows"
+            )
+        elif loaded != checksum.values():
+            errors.append(
+                f"the checksum of the loaded rows is {checksum.values()[1:]} in memory"
+                f" but {loaded[1:]} in the database"
+            )
+
+    for parent, count in orphans(session, model, parents).items():
+        if count:
+            errors.append(f"{count} rows reference a {parent} row that doesn't exist")
+
+    if errors:
+        raise VerificationError(f"Verification of {table} failed: " + "; ".join(errors))
+
+
+__all__ = [
+    "VerificationError",
+    "Checksum",
+    "aggregates",
+    "verify_table",
+]
@@ -0,0 +1,283 @@
+import math
+import random
+import threading
+from argparse import ArgumentTypeError
+from time import perf_counter
+from typing import Callable, Optional, TypedDict
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, and_, select
+from bda_nesprisa.sharding import Seed
+from bda_nesprisa.tables.keystore import KeyStore
+from bda_nesprisa.tables.types import (
+    TableName,
+    Carrito,
+    Contiene,
+    Oferta,
+    Receta,
+    VarEnCafetera,
+    Variedad,
+)
+
+# READ WORKLOAD
+
+# After loading the data we can benchmark the database by running a mix of representative queries
+# with several concurrent clients, reporting the latency percentiles and queries per second of each query
+# The parameters of the queries are drawn from the rows generated in the run, so every query hits real data
+
+# Each query is defined by the table its parameters are drawn from, a function that, given the rows of the run and
+# a random generator, returns the parameters, and a function that, given the parameters, returns the select statement
+# NOTE: each client keeps a connection from the engine pool during the whole workload, so the pool has to allow
+#       as many connections as clients (SQLAlchemy allows 15 by default)
+
+
+# 1. Carts (with their lines) of a customer that has carts
+def carts_per_customer_params(rows: dict[TableName, KeyStore], rng: random.Random):
+    return {"dni": rng.choice(rows["carrito"]).dni_cliente}
+
+
+def carts_per_customer(dni: str):
+    return (
+        select(Carrito, Contiene)
+        .join(
+            Contiene,
+            and_(
+                Contiene.id_tienda == Carrito.id_tienda,
+                Contiene.id_carrito == Carrito.id_carrito,
+            ),
+        )
+        .where(Carrito.dni_cliente == dni)
+    )
+
+
+# 2. Varieties that can be used in a coffee machine
+def varieties_per_machine_params(rows: dict[TableName, KeyStore], rng: random.Random):
+    row = rng.choice(rows["var_en_cafetera"])
+    return {"fabricante": row.fabricante_caf, "modelo": row.modelo_caf}
+
+
+def varieties_per_machine(fabricante: str, modelo: str):
+    return (
+        select(Variedad)
+        .join(VarEnCafetera, VarEnCafetera.id_variedad == Variedad.id_variedad)
+        .where(
+            VarEnCafetera.fabricante_caf == fabricante,
+            VarEnCafetera.modelo_caf == modelo,
+        )
+    )
+
+
+# 3. Offers active on a date, chosen as the start date of an existing offer
+#    (only key columns are used as parameters, since rows read back from the database only have those)
+def active_offers_params(rows: dict[TableName, KeyStore], rng: random.Random):
+    return {"fecha": rng.choice(rows["oferta"]).fecha_inicio}
+
+
+def active_offers(fecha):
+    return select(Oferta).where(Oferta.fecha_inicio <= fecha, Oferta.fecha_fin >= fecha)
+
+
+# 4. Recipes (with their varieties) that use a grain type
+def recipes_by_grain_params(rows: dict[TableName, KeyStore], rng: random.Random):
+    return {"id_tipo_grano": rng.choice(rows["receta"]).id_tipo_grano}
+
+
+def recipes_by_grain(id_tipo_grano: str):
+    return (
+        select(Receta, Variedad)
+        .join(Variedad, Variedad.id_variedad == Receta.id_variedad)
+        .where(Receta.id_tipo_grano == id_tipo_grano)
+    )
+
+
+QueryDictValue = TypedDict(
+    "QueryDictValue", {"table": TableName, "params": Callable, "statement": Callable}
+)
+queries: dict[str, QueryDictValue] = {
+    "carts_per_customer": {
+        "table": "carrito",
+        "params": carts_per_customer_params,
+        "statement": carts_per_customer,
+    },
+    "varieties_per_machine": {
+        "table": "var_en_cafetera",
+        "params": varieties_per_machine_params,
+        "statement": varieties_per_machine,
+    },
+    "active_offers": {
+        "table": "oferta",
+        "params": active_offers_params,
+        "statement": active_offers,
+    },
+    "recipes_by_grain": {
+        "table": "receta",
+        "params": recipes_by_grain_params,
+        "statement": recipes_by_grain,
+    },
+}
+
+# Tables whose rows the queries need
+WORKLOAD_TABLES: list[TableName] = [query["table"] for query in queries.values()]
+
+# Relative weight of each query in the mix
+DEFAULT_MIX: dict[str, float] = {
+    "carts_per_customer": 4,
+    "varieties_per_machine": 2,
+    "active_offers": 2,
+    "recipes_by_grain": 1,
+}
+
+
+class WorkloadOptions(TypedDict):
+    mix: dict[str, float]
+    clients: int
+    duration: float
+
+
+class QueryReport(TypedDict):
+    count: int
+    qps: float
+    p50: float
+    p95: float
+    p99: float
+    max: float
+
+
+class WorkloadReport(TypedDict):
+    clients: int
+    duration: float
+    count: int
+    qps: float
+    queries: dict[str, QueryReport]
+
+
+# Type for the --workload-mix argument, which has the format query=weight,query=weight,...
+def parse_mix(value: str):
+    mix: dict[str, float] = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name not in queries:
+            raise ArgumentTypeError(
+                f"unknown query {name!r}, choose from {', '.join(queries)}"
+            )
+        try:
+            mix[name] = float(weight)
+        except ValueError:
+            raise ArgumentTypeError(f"weight of {name!r} must be a number")
+    return mix
+
+
+# Value below which are the given fraction of the sorted latencies (nearest-rank method)
+def percentile(latencies: list[float], fraction: float):
+    return latencies[max(math.ceil(fraction * len(latencies)) - 1, 0)]
+
+
+def run_workload(
+    engine: Engine,
+    rows: dict[TableName, KeyStore],
+    mix: dict[str, float] = DEFAULT_MIX,
+    clients: int = 4,
+    duration: float = 30.0,
+    seed: Optional[Seed] = None,
+):
+    # Queries whose table has no rows in this run can't hit real data, so we leave them out
+    names = [
+        name
+        for name, weight in mix.items()
+        if weight > 0 and rows[queries[name]["table"]]
+    ]
+    if not names:
+        raise ValueError(
+            "None of the queries of the mix has rows to draw parameters from"
+        )
+    weights = [mix[name] for name in names]
+
+    # Latencies of each query measured by each client, so clients don't have to share a lock
+    latencies: list[dict[str, list[float]]] = [
+        {name: [] for name in names} for _ in range(clients)
+    ]
+    errors: list[BaseException] = []
+
+    def client(index: int, deadline: float):
+        rng = random.Random(None if seed is None else f"{seed}:workload:{index}")
+        try:
+            with Session(engine) as session:
+                while perf_counter() < deadline:
+                    name = rng.choices(names, weights)[0]
+                    statement = queries[name]["statement"](
+                        **queries[name]["params"](rows, rng)
+                    )
+                    start = perf_counter()
+                    session.exec(statement).all()
+                    latencies[index][name].append(perf_counter() - start)
+                    # We don't need the loaded rows anymore, so we stop tracking them
+                    session.expunge_all()
+        except BaseException as e:
+            errors.append(e)
+
+    start = perf_counter()
+    threads = [
+        threading.Thread(target=client, args=(index, start + duration))
+        for index in range(clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+
+    if errors:
+        raise errors[0]
+
+    report: WorkloadReport = {
+        "clients": clients,
+        "duration": elapsed,
+        "count": 0,
+        "qps": 0.0,
+        "queries": {},
+    }
+    for name in names:
+        query_latencies = sorted(
+            latency
+            for client_latencies in latencies
+            for latency in client_latencies[name]
+        )
+        if not query_latencies:
+            continue
+        report["count"] += len(query_latencies)
+        report["queries"][name] = {
+            "count": len(query_latencies),
+            "qps": len(query_latencies) / elapsed,
+            "p50": percentile(query_latencies, 0.5),
+            "p95": percentile(query_latencies, 0.95),
+            "p99": percentile(query_latencies, 0.99),
+            "max": query_latencies[-1],
+        }
+    report["qps"] = report["count"] / elapsed
+    return report
+
+
+def format_workload(report: WorkloadReport):
+    lines = [
+        f"{report['count']} queries with {report['clients']} clients in {report['duration']:.1f} s"
+        f" ({report['qps']:.1f} queries/s)",
+        f"{'query':<24}{'count':>8}{'qps':>10}{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}{'max (ms)':>10}",
+    ]
+    for name, query in report["queries"].items():
+        lines.append(
+            f"{name:<24}{query['count']:>8}{query['qps']:>10.1f}"
+            + "".join(
+                f"{query[stat] * 1000:>10.2f}" for stat in ("p50", "p95", "p99", "max")
+            )
+        )
+    return "\n".join(lines)
+
+
+__all__ = [
+    "WORKLOAD_TABLES",
+    "DEFAULT_MIX",
+    "WorkloadOptions",
+    "WorkloadReport",
+    "parse_mix",
+    "run_workload",
+    "format_workload",
+]
@@ -0,0 +1,165 @@
+import random
+from datetime import date
+import pytest
+from tqdm import tqdm
+from bda_nesprisa.tables import create_rows, fake, table_specs
+from bda_nesprisa.tables.engine import (
+    RandomPermutation,
+    build_table,
+    foreign_key_groups,
+    unique_key,
+    unique_parts,
+)
+from bda_nesprisa.tables.keystore import KeyBudget, KeyStore
+from bda_nesprisa.tables.types import table_names
+
+# Rows of each table at the scale of the planner samples, besides the tables whose whole key space is generated
+SAMPLE_ROWS = 10
+# Small parent tables, so the tables sampled from their product use all of it (e.g. plantacion)
+PARENT_ROWS = {"pais": 2, "region": 4, "responsable_plantacion": 3}
+FULL_TABLES = ("plantacion",)
+
+# Tables whose unique key is enforced by the engine (the rest have practically unbounded keys, e.g. uuid)
+ENFORCED_TABLES = [
+    table
+    for table, spec in table_specs.items()
+    if unique_parts(spec, foreign_key_groups(spec["model"])) is not None
+]
+
+
+# Generates every table in order, giving each one the key stores of the tables generated before it
+@pytest.fixture(scope="module")
+def generated():
+    random.seed(0)
+    fake.seed_instance(0)
+    fake.unique.clear()
+
+    rows = {}
+    stores = {}
+    counts = {}
+    with tqdm(disable=True) as pbar:
+        for table in table_names:
+            key_space = create_rows[table]["key_space"](counts)
+            num_rows = PARENT_ROWS.get(table, SAMPLE_ROWS)
+            if key_space is not None:
+                num_rows = (
+                    key_space if table in FULL_TABLES else min(num_rows, key_space)
+                )
+            counts[table] = num_rows
+
+            created = list(
+                create_rows[table]["fn"](
+                    **{f"{k}_list": v for k, v in stores.items()},
+                    num_rows=num_rows,
+                    pbar=pbar,
+                )
+            )
+            # The database assigns the carrito ids
+            if table == "carrito":
+                for id_carrito, row in enumerate(created, 1):
+                    row.id_carrito = id_carrito
+
+            assert len(created) == num_rows
+            rows[table] = created
+            stores[table] = KeyStore(table_specs[table]["model"])
+            stores[table].extend(created)
+    fake.unique.clear()
+    return rows
+
+
+@pytest.mark.parametrize("table", ENFORCED_TABLES)
+def test_unique_keys(generated, table):
+    spec = table_specs[table]
+    keys = [
+        tuple(getattr(row, column) for column in unique_key(spec))
+        for row in generated[table]
+    ]
+    assert len(set(keys)) == len(keys)
+
+
+def test_enforced_tables():
+    # The unique override of plantacion and the generated date of oferta are enforced
+    for table in ("plantacion", "oferta", "anyadir", "tiene_cafetera"):
+        assert table in ENFORCED_TABLES
+
+
+# With a single possible date, every variedad can only have one oferta, so the engine has to discard
+# the repeated keys until it finds the ones left (also when the keys already used are spilled to disk)
+@pytest.mark.parametrize("spilled", [False, True])
+def test_repeated_keys(generated, tmp_path, spilled):
+    spec = table_specs["oferta"]
+    table = build_table(
+        {
+            **spec,
+            "columns": {**spec["columns"], "fecha_inicio": lambda _: date(2000, 1, 1)},
+            "sizes": {"fecha_inicio": lambda: 1},
+        }
+    )
+    variedades = KeyStore(table_specs["variedad"]["model"])
+    variedades.extend(generated["variedad"])
+    num_rows = table["key_space"]({"variedad": len(variedades)})
+    assert num_rows == len(variedades)
+
+    with tqdm(disable=True) as pbar:
+        created = list(
+            table["fn"](
+                num_rows=num_rows,
+                pbar=pbar,
+                key_budget=KeyBudget(1, str(tmp_path)) if spilled else None,
+                variedad_list=variedades,
+            )
+        )
+    assert {row.id_variedad for row in created} == {
+        row.id_variedad for row in generated["variedad"]
+    }
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_full_key_space(generated):
+    # Sampling without replacement from the product of the parents gives every key once
+    keys = {
+        (row.id_pais, row.id_region, row.dni_responsable)
+        for row in generated["plantacion"]
+    }
+    regions = {(row.id_pais, row.id_region) for row in generated["region"]}
+    responsables = {row.dni_responsable for row in generated["responsable_plantacion"]}
+    assert keys == {
+        (*region, responsable) for region in regions for responsable in responsables
+    }
+
+
+@pytest.mark.parametrize("table", table_names)
+def test_foreign_keys(generated, table):
+    for group in foreign_key_groups(table_specs[table]["model"]):
+        # All the columns of a group come from the same parent row
+        parents = {
+            tuple(getattr(row, column) for column in group.parent_columns)
+            for row in generated[group.table]
+        }
+        for row in generated[table]:
+            key = tuple(getattr(row, column) for column in group.columns)
+            if None not in key:
+                assert key in parents
+
+
+def test_grouped_columns():
+    groups = {
+        group.table: group
+        for group in foreign_key_groups(table_specs["plantacion"]["model"])
+    }
+    # id_pais is taken from the region, not from a random pais
+    assert "pais" not in groups
+    assert set(groups["region"].columns) == {"id_pais", "id_region"}
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 12, 1000, 1025])
+def test_random_permutation(size):
+    random.seed(size)
+    permutation = RandomPermutation(size)
+    assert sorted(permutation[index] for index in range(size)) == list(range(size))
+    # Seeded runs give the same permutation
+    random.seed(size)
+    again = RandomPermutation(size)
+    assert [again[index] for index in range(size)] == [
+        permutation[index] for index in range(size)
+    ]
@@ -0,0 +1,133 @@
+from datetime import date
+import pytest
+from bda_nesprisa.tables.keystore import MIN_CAPACITY, KeyBudget, KeyStore
+from bda_nesprisa.tables.types import Carrito, Oferta
+
+
+# Keys of carrito (id_tienda, id_carrito, dni_cliente), with some NULL dnis and more keys than the initial
+# capacity of a file so it has to grow
+def carrito_keys(count=3 * MIN_CAPACITY):
+    return [
+        (f"tienda{i % 97}", i, None if i % 11 == 0 else f"{i:08d}X")
+        for i in range(count)
+    ]
+
+
+def oferta_keys(count=500):
+    return [(f"variedad{i % 13}", date(2000, 1, 1 + i % 28)) for i in range(count)]
+
+
+# The same keys in a store in memory and in a store spilled to disk
+def stores(model, keys, tmp_path, columns=None):
+    in_memory = KeyStore(model, columns)
+    in_memory.extend_keys(keys)
+    spilled = KeyStore(model, columns, KeyBudget(1, str(tmp_path)))
+    spilled.extend_keys(keys)
+    assert in_memory.keys is not None
+    assert spilled.keys is None
+    return in_memory, spilled
+
+
+def test_indexing(tmp_path):
+    keys = carrito_keys()
+    in_memory, spilled = stores(Carrito, keys, tmp_path)
+    assert len(in_memory) == len(spilled) == len(keys)
+    for index in (0, 1, 11, MIN_CAPACITY, len(keys) - 1, -1, -len(keys)):
+        assert in_memory[index] == spilled[index] == keys[index]
+    assert spilled[11].dni_cliente is None
+    assert list(in_memory) == list(spilled) == keys
+    with pytest.raises(IndexError):
+        spilled[len(keys)]
+
+
+def test_dates(tmp_path):
+    keys = oferta_keys()
+    in_memory, spilled = stores(Oferta, keys, tmp_path, ("id_variedad", "fecha_inicio"))
+    assert list(in_memory) == list(spilled) == keys
+    assert spilled[5].fecha_inicio == date(2000, 1, 6)
+
+
+def test_slices_and_projections(tmp_path):
+    keys = carrito_keys()
+    in_memory, spilled = stores(Carrito, keys, tmp_path)
+    for view in (
+        lambda store: store[1::3],
+        lambda store: store[::-2][5:40],
+        lambda store: store.project(("dni_cliente", "id_tienda")),
+        lambda store: store[2::5].project(("id_carrito",)),
+        lambda store: store.project(("id_carrito", "id_tienda"))[10:20],
+    ):
+        assert list(view(in_memory)) == list(view(spilled))
+        assert len(view(in_memory)) == len(view(spilled))
+    assert spilled[2::5].project(("id_carrito",))[3] == (17,)
+
+
+def test_membership(tmp_path):
+    keys = carrito_keys()
+    in_memory, spilled = stores(Carrito, keys, tmp_path)
+    for key in keys[::7] + [
+        ("tienda1", 1, None),
+        ("other", 5, "x"),
+        ("tienda0", 0, None),
+    ]:
+        assert (key in in_memory) == (key in spilled) == (key in keys)
+
+
+def test_widen(tmp_path):
+    keys = carrito_keys()
+    in_memory, spilled = stores(Carrito, keys, tmp_path)
+    # Build the index before widening, so it has to be rebuilt in the new file
+    assert keys[3] in spilled
+    width = spilled.file.widths[0]
+
+    long_key = ("t" * (width + 1), len(keys), "d" * 100)
+    in_memory.append_key(long_key)
+    spilled.append_key(long_key)
+
+    assert spilled.file.widths[0] > width
+    assert list(in_memory) == list(spilled) == keys + [long_key]
+    assert long_key in spilled
+    assert keys[3] in spilled
+    assert ("t" * width, len(keys), "d" * 100) not in spilled
+
+
+def test_index_rebuild(tmp_path):
+    keys = carrito_keys(MIN_CAPACITY // 4)
+    in_memory, spilled = stores(Carrito, keys, tmp_path)
+    assert keys[0] in spilled
+    slots = len(spilled.file.slots)
+
+    # Appending past half of the slots rebuilds the index with more of them
+    more = [(f"more{i}", i, None) for i in range(slots)]
+    for key in more:
+        in_memory.append_key(key)
+        spilled.append_key(key)
+
+    assert len(spilled.file.slots) > slots
+    assert len(in_memory) == len(spilled)
+    for key in keys + more:
+        assert key in spilled
+    assert ("more", -1, None) not in spilled
+
+
+def test_close(tmp_path):
+    budget = KeyBudget(1, str(tmp_path))
+    store = KeyStore(Carrito, budget=budget)
+    store.extend_keys(carrito_keys())
+    assert ("tienda0", 0, None) in store
+    store.close()
+    assert list(tmp_path.iterdir()) == []
+    assert budget.memory == 0
+
+
+def test_spill_on_membership(tmp_path):
+    keys = carrito_keys(1000)
+    store = KeyStore(Carrito, budget=KeyBudget(200_000, str(tmp_path)))
+    store.extend_keys(keys)
+    assert store.keys is not None
+    # The memory of the membership set goes over the budget and spills the store
+    assert ("t", 1, "d") not in store
+    assert store.keys is None
+    assert list(store) == keys
+    for key in keys[::7]:
+        assert key in store
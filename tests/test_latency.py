@@ -0,0 +1,23 @@
+from sqlmodel import Session, func, select
+from bda_nesprisa.__main__ import main
+from bda_nesprisa.latency import LatencyInjector
+from bda_nesprisa.tables import create_rows, table_specs
+from bda_nesprisa.tables.types import table_names
+
+
+def test_round_trips():
+    injector = LatencyInjector(round_trip=0, per_row=0)
+    main(engine=injector.engine, seed=1)
+
+    # Every table is loaded in one batch (an INSERT and a commit) and checked with a few aggregate queries,
+    # so a query for each row would show up here
+    assert injector.stats["round_trips"] == 145
+    assert injector.stats["statements"] == 125
+    assert injector.stats["commits"] == 20
+
+    with Session(injector.engine) as session:
+        for table in table_names:
+            count = session.exec(
+                select(func.count()).select_from(table_specs[table]["model"])
+            ).one()
+            assert count == create_rows[table]["num_rows"], table